@@ -1,6 +1,39 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-from pymongo import MongoClient, errors
+import io
+import asyncio
+import hashlib
+import re
+import csv
+import heapq
+import json
+import math
+import multiprocessing
+import zlib
+import time
+import threading
+import contextvars
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import click
+import bson
+from bson import ObjectId
+from bson.errors import InvalidId
+try:
+    # pymongo >= 4.9; only needed for ASYNC_MONGO=1
+    from pymongo import AsyncMongoClient
+except ImportError:
+    AsyncMongoClient = None
+try:
+    # optional: vectorized tariff charges for batch billing
+    import numpy as np
+except ImportError:
+    np = None
+from pymongo import MongoClient, IndexModel, ReplaceOne, UpdateOne, ReturnDocument, ASCENDING, DESCENDING, errors
+from pymongo import timeout as mongo_timeout
+from pymongo import monitoring
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from dotenv import load_dotenv
@@ -9,57 +42,366 @@ from dotenv import load_dotenv
 load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017")
 SECRET_KEY = os.getenv("SECRET_KEY", "devsecret")
+SHARD_QUERY_WORKERS = int(os.getenv("SHARD_QUERY_WORKERS", "9"))
+SHARD_JOB_WORKERS = int(os.getenv("SHARD_JOB_WORKERS", "9"))
+SHARD_QUERY_TIMEOUT = float(os.getenv("SHARD_QUERY_TIMEOUT", "5"))
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+PAGE_COUNT_LIMIT = int(os.getenv("PAGE_COUNT_LIMIT", "1000"))
+SHARD_STATS_TTL = float(os.getenv("SHARD_STATS_TTL", "60"))
+SHARD_STATS_EXACT = os.getenv("SHARD_STATS_EXACT", "0") == "1"
+SHARD_STATS_RETENTION_DAYS = int(os.getenv("SHARD_STATS_RETENTION_DAYS", "30"))
+ENSURE_INDEXES = os.getenv("ENSURE_INDEXES", "1") == "1"
+METER_BLOCK_SIZE = int(os.getenv("METER_BLOCK_SIZE", "20"))
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "60"))
+# werkzeug method string, e.g. "scrypt", "scrypt:16384:8:1", "pbkdf2:sha256:600000"
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "0"))
+SHARD_MAP_TTL = float(os.getenv("SHARD_MAP_TTL", "10"))
+ASYNC_MONGO = os.getenv("ASYNC_MONGO", "0") == "1"
+# Connection pool, per process (a pre-fork server multiplies it by workers)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", "0")) or None
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0")) or None
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0")) or None
+MONGO_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SELECTION_TIMEOUT_MS", "5000"))
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "2"))
+DB_METRICS = os.getenv("DB_METRICS", "1") == "1"
+DB_DEBUG_HEADER = os.getenv("DB_DEBUG_HEADER", "1") == "1"
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
-# Connect to MongoDB
-try:
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    client.server_info()
-except Exception as e:
-    print("WARNING: could not connect to MongoDB:", e)
-    client = None
+# ---- MongoDB connection ----
+# Nothing connects at import: each process creates its own MongoClient on
+# first use, so workers boot without waiting on Mongo and a pre-fork server
+# (gunicorn) never shares a client's sockets and monitor threads across a fork.
+_mongo = {'pid': None, 'client': None}
+_mongo_lock = threading.Lock()
+
+def mongo_client_options():
+    return {
+        'maxPoolSize': MONGO_MAX_POOL_SIZE,
+        'minPoolSize': MONGO_MIN_POOL_SIZE,
+        'maxIdleTimeMS': MONGO_MAX_IDLE_MS,
+        'waitQueueTimeoutMS': MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        'connectTimeoutMS': MONGO_CONNECT_TIMEOUT_MS,
+        'socketTimeoutMS': MONGO_SOCKET_TIMEOUT_MS,
+        'serverSelectionTimeoutMS': MONGO_SELECTION_TIMEOUT_MS,
+        'event_listeners': [_db_listener] if DB_METRICS else [],
+    }
+
+def get_client():
+    """This process's MongoClient, or None if MONGO_URI is unusable."""
+    if _mongo['pid'] == os.getpid():
+        return _mongo['client']
+    with _mongo_lock:
+        if _mongo['pid'] != os.getpid():
+            try:
+                _mongo['client'] = MongoClient(MONGO_URI, **mongo_client_options())
+            except Exception as e:
+                print("WARNING: could not create MongoDB client:", e)
+                _mongo['client'] = None
+            _mongo['pid'] = os.getpid()
+            if _mongo['client'] is not None and ENSURE_INDEXES:
+                threading.Thread(target=_ensure_indexes_bg, daemon=True).start()
+    return _mongo['client']
+
+# ---- Metrics ----
+# Prometheus text format, per process (each gunicorn worker has its own
+# counters). A pymongo CommandListener attributes every command to the Flask
+# route that caused it through the _db_request context variable; shard pool
+# threads and the async loop run with a copy of the request's context.
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+METRICS_HELP = {
+    'edb_http_request_seconds': ('histogram', 'Request latency by route'),
+    'edb_http_request_queries': ('histogram', 'Database commands issued per request'),
+    'edb_db_command_seconds': ('histogram', 'Database command latency by route, database and collection'),
+    'edb_db_documents_total': ('counter', 'Documents returned or written by database commands'),
+    'edb_db_reply_bytes_total': ('counter', 'BSON bytes of database command replies'),
+    'edb_db_command_failures_total': ('counter', 'Failed database commands'),
+}
+_metrics = {}
+_metrics_lock = threading.Lock()
+_db_request = contextvars.ContextVar('db_request', default=None)
+
+def observe(name, labels, value, buckets):
+    with _metrics_lock:
+        h = _metrics.setdefault(name, {}).get(labels)
+        if h is None:
+            h = _metrics[name][labels] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for i, le in enumerate(buckets):
+            if value <= le:
+                h['counts'][i] += 1
+        h['sum'] += value
+        h['count'] += 1
+
+def inc(name, labels, amount=1):
+    with _metrics_lock:
+        series = _metrics.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + amount
+
+def _label_str(labels):
+    def esc(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{k}="{esc(v)}"' for k, v in labels)
+
+def render_metrics():
+    lines = []
+    with _metrics_lock:
+        for name in sorted(_metrics):
+            kind, help_text = METRICS_HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(_metrics[name].items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{{{_label_str(labels)}}} {value}")
+                    continue
+                for le, n in zip(value['buckets'], value['counts']):
+                    lines.append(f"{name}_bucket{{{_label_str(labels + (('le', le),))}}} {n}")
+                lines.append(f"{name}_bucket{{{_label_str(labels + (('le', '+Inf'),))}}} {value['count']}")
+                lines.append(f"{name}_sum{{{_label_str(labels)}}} {value['sum']}")
+                lines.append(f"{name}_count{{{_label_str(labels)}}} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+def _reply_documents(command_name, reply):
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    if 'n' in reply:
+        return reply['n']
+    return 1 if reply.get('value') is not None else 0
+
+class DbCommandListener(monitoring.CommandListener):
+    """Records each command under the route that issued it."""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        col = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            col = event.command.get('collection')
+        req = _db_request.get()
+        self._pending[(event.connection_id, event.request_id)] = (
+            col if isinstance(col, str) else '', req
+        )
+
+    def _finish(self, event):
+        col, req = self._pending.pop((event.connection_id, event.request_id), ('', None))
+        route = req['route'] if req else 'background'
+        labels = (('route', route), ('database', event.database_name),
+                  ('collection', col), ('command', event.command_name))
+        seconds = event.duration_micros / 1e6
+        observe('edb_db_command_seconds', labels, seconds, DB_BUCKETS)
+        if req is not None:
+            with _metrics_lock:
+                req['queries'] += 1
+                req['db_seconds'] += seconds
+        return labels[:3]
+
+    def succeeded(self, event):
+        labels = self._finish(event)
+        reply = event.reply or {}
+        inc('edb_db_documents_total', labels, _reply_documents(event.command_name, reply))
+        try:
+            inc('edb_db_reply_bytes_total', labels, len(bson.encode(reply)))
+        except Exception:
+            pass
+
+    def failed(self, event):
+        inc('edb_db_command_failures_total', self._finish(event))
+
+_db_listener = DbCommandListener()
+
+def submit_shard(fn, *args, job=False):
+    """Run fn on the shard pool with the caller's context (for metrics).
+
+    job=True runs it on the long-job pool instead. The future's started
+    dict gets 'at' (time.monotonic()) once fn begins running.
+    """
+    ctx = contextvars.copy_context()
+    started = {}
+
+    def run():
+        started['at'] = time.monotonic()
+        return ctx.run(fn, *args)
+    fut = _shard_pool('job' if job else 'query').submit(run)
+    fut.started = started
+    return fut
+
+@app.before_request
+def _start_request_metrics():
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request._db_token = _db_request.set({'route': rule, 'queries': 0, 'db_seconds': 0.0,
+                                         'start': time.perf_counter()})
+
+@app.after_request
+def _record_request_metrics(response):
+    req = _db_request.get()
+    if req is None:
+        return response
+    labels = (('route', req['route']), ('method', request.method))
+    observe('edb_http_request_seconds', labels + (('status', response.status_code),),
+            time.perf_counter() - req['start'], HTTP_BUCKETS)
+    observe('edb_http_request_queries', labels, req['queries'], QUERY_COUNT_BUCKETS)
+    if DB_DEBUG_HEADER:
+        response.headers['X-DB-Queries'] = str(req['queries'])
+        response.headers['X-DB-Time-Ms'] = f"{req['db_seconds'] * 1000:.1f}"
+    return response
+
+@app.teardown_request
+def _end_request_metrics(exc):
+    token = getattr(request, '_db_token', None)
+    if token is not None:
+        _db_request.reset(token)
 
 # Config
 ADMIN_DB = "managementdb"
-DB_NAMES = ['Nesco1','Nesco2','Nesco3','Desco1','Desco2','Desco3','PBS1','PBS2','PBS3']
+REGIONS = ('Nesco', 'Desco', 'PBS')
 
 def admin_coll():
-    return client[ADMIN_DB]['admin'] if client is not None else None
+    return get_client()[ADMIN_DB]['admin'] if get_client() is not None else None
 
 def company_coll():
-    return client[ADMIN_DB]['company'] if client is not None else None
+    return get_client()[ADMIN_DB]['company'] if get_client() is not None else None
 
-def choose_db(location: str, user_id: int = None) -> str:
+def counters_coll():
+    return get_client()[ADMIN_DB]['counters'] if get_client() is not None else None
+
+def identity_coll():
+    return get_client()[ADMIN_DB]['identity'] if get_client() is not None else None
+
+def identity_changes_coll():
+    return get_client()[ADMIN_DB]['identity_changes'] if get_client() is not None else None
+
+def region_prefix(location: str) -> str:
     loc = (location or '').strip().lower()
     if loc in ('rajshahi', 'nesco'):
-        prefix = 'Nesco'
-    elif loc in ('dhaka', 'desco'):
-        prefix = 'Desco'
-    else:
-        prefix = 'PBS'
-
+        return 'Nesco'
+    if loc in ('dhaka', 'desco'):
+        return 'Desco'
+    return 'PBS'
+
+# ---- Shard map ----
+# Routing lives in managementdb.shard_map (one document, _id "current") and
+# is cached per process. Workers re-read only its version every
+# SHARD_MAP_TTL seconds and reload the map when it was bumped.
+# Per region, either:
+#   {'strategy': 'range', 'ranges': [[min_id, max_id, db], ...], 'fallback': db}
+#   {'strategy': 'hash', 'shards': [db, ...]}
+DEFAULT_SHARD_MAP = {
+    region: {
+        'strategy': 'range',
+        'ranges': [[1, 100, f'{region}1'], [101, 200, f'{region}2'], [201, 300, f'{region}3']],
+        'fallback': f'{region}default'
+    }
+    for region in REGIONS
+}
+_shard_map = {'version': 0, 'regions': DEFAULT_SHARD_MAP, 'checked_at': 0.0}
+_shard_map_lock = threading.Lock()
+
+def shard_map_coll():
+    return get_client()[ADMIN_DB]['shard_map'] if get_client() is not None else None
+
+def get_shard_map():
+    """Region -> routing config, refreshed when the stored version changes."""
+    col = shard_map_coll()
+    now = time.time()
+    if col is None or now - _shard_map['checked_at'] < SHARD_MAP_TTL:
+        return _shard_map['regions']
+    with _shard_map_lock:
+        _shard_map['checked_at'] = now
+        try:
+            current = col.find_one({'_id': 'current'}, {'version': 1})
+            if current is None:
+                col.update_one({'_id': 'current'},
+                               {'$setOnInsert': {'version': 1, 'regions': DEFAULT_SHARD_MAP}}, upsert=True)
+                current = {'version': 1}
+            if current['version'] != _shard_map['version']:
+                doc = col.find_one({'_id': 'current'})
+                _shard_map['regions'] = doc['regions']
+                _shard_map['version'] = doc['version']
+        except Exception:
+            pass
+    return _shard_map['regions']
+
+def save_shard_map(regions):
+    """Store a new map and bump its version; every worker picks it up."""
+    for region, cfg in regions.items():
+        if cfg.get('strategy') not in ('range', 'hash'):
+            raise ValueError(f"{region}: strategy must be 'range' or 'hash'")
+        if cfg['strategy'] == 'hash' and not cfg.get('shards'):
+            raise ValueError(f"{region}: hash strategy needs at least one shard")
+    doc = shard_map_coll().find_one_and_update(
+        {'_id': 'current'},
+        {'$set': {'regions': regions}, '$inc': {'version': 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    _shard_map['checked_at'] = 0.0
+    return doc['version']
+
+def region_db_names(prefix):
+    """Every database of a region, in routing order."""
+    cfg = get_shard_map().get(prefix) or DEFAULT_SHARD_MAP['PBS']
+    if cfg['strategy'] == 'hash':
+        return list(cfg['shards'])
+    names = []
+    for _, _, dbn in cfg['ranges']:
+        if dbn not in names:
+            names.append(dbn)
+    if cfg.get('fallback') and cfg['fallback'] not in names:
+        names.append(cfg['fallback'])
+    return names
+
+def shard_db_names():
+    """Every shard database across all regions."""
+    regions = get_shard_map()
+    return [dbn for region in regions for dbn in region_db_names(region)]
+
+def route_shard(prefix, user_id=None):
+    cfg = get_shard_map().get(prefix) or DEFAULT_SHARD_MAP['PBS']
+    if cfg['strategy'] == 'hash':
+        shards = cfg['shards']
+        if user_id is None:
+            return shards[0]
+        return shards[zlib.crc32(str(user_id).encode()) % len(shards)]
     if user_id is None:
-        # Default: pick the DB with most users? Or suffix 1
-        suffix = '1'
-    elif 1 <= user_id <= 100:
-        suffix = '1'
-    elif 101 <= user_id <= 200:
-        suffix = '2'
-    elif 201 <= user_id <= 300:
-        suffix = '3'
-    else:
-        suffix = 'default'
-    return f"{prefix}{suffix}"
+        return cfg['ranges'][0][2]
+    for low, high, dbn in cfg['ranges']:
+        if low <= user_id <= high:
+            return dbn
+    return cfg.get('fallback') or cfg['ranges'][-1][2]
 
+def choose_db(location: str, user_id: int = None) -> str:
+    return route_shard(region_prefix(location), user_id)
+
+@app.cli.command('show-shard-map')
+def show_shard_map_command():
+    """Print the current shard map and its version."""
+    regions = get_shard_map()
+    click.echo(f"version {_shard_map['version']}")
+    click.echo(json.dumps(regions, indent=2))
+
+@app.cli.command('load-shard-map')
+@click.argument('path', type=click.Path(exists=True))
+def load_shard_map_command(path):
+    """Replace the shard map with the JSON file at PATH and bump its version."""
+    with open(path) as f:
+        regions = json.load(f)
+    click.echo(f"Shard map is now version {save_shard_map(regions)}")
 
 def get_db_for_location(location, user_id=1):
-    if client is None:
+    if get_client() is None:
         return None
     db_name = choose_db(location, user_id)
     try:
-        return client[db_name]
+        return get_client()[db_name]
     except Exception:
         return None
 
@@ -71,9 +413,2218 @@ def get_collections(db):
         'Prepaid': db['Prepaid'],
         'Postpaid': db['Postpaid'],
         'Meter_inf': db['Meter_inf'],
-        'Bill': db['Bill']
+        'Bill': db['Bill'],
+        'Payment': db['Payment'],
+        'Account': db['Account']
     }
 
+# ---- Index registry ----
+# Every index the app relies on, per collection. ensure_indexes() applies
+# them to managementdb and every shard; create_indexes is a no-op for
+# indexes that already exist with the same spec.
+ADMIN_INDEXES = {
+    'admin': [IndexModel([('id', ASCENDING)], name='id_unique', unique=True)],
+    'company': [IndexModel([('id', ASCENDING)], name='id_unique', unique=True)],
+    'identity': [IndexModel([('id', ASCENDING)], name='id')],
+    # snapshots written on every refresh expire after SHARD_STATS_RETENTION_DAYS
+    'shard_stats': [IndexModel([('at', ASCENDING)], name='at_ttl',
+                               expireAfterSeconds=SHARD_STATS_RETENTION_DAYS * 86400)],
+    'identity_changes': [IndexModel([('at', ASCENDING)], name='at_ttl', expireAfterSeconds=86400)],
+}
+
+SHARD_INDEXES = {
+    'Agent': [IndexModel([('id', ASCENDING)], name='id_unique', unique=True)],
+    'Prepaid': [IndexModel([('id', ASCENDING)], name='id_unique', unique=True)],
+    'Postpaid': [IndexModel([('id', ASCENDING)], name='id_unique', unique=True)],
+    'Meter_inf': [IndexModel([('meter_no', ASCENDING)], name='meter_no_unique', unique=True)],
+    'Bill': [
+        # unpaid lookups (agent_pay, company_postpaid_users)
+        IndexModel([('id', ASCENDING), ('status', ASCENDING)], name='id_status'),
+        # latest bill per user (company_bill_user)
+        IndexModel([('id', ASCENDING), ('_id', DESCENDING)], name='id_latest'),
+        # one bill per customer per batch billing period
+        IndexModel([('id', ASCENDING), ('period', ASCENDING)], name='id_period_unique', unique=True,
+                   partialFilterExpression={'period': {'$exists': True}}),
+        IndexModel([('payment_key', ASCENDING)], name='payment_key', sparse=True),
+        # agent bill search: status filter / due-date range, newest first
+        IndexModel([('status', ASCENDING), ('_id', DESCENDING)], name='status_latest'),
+        IndexModel([('due_date', ASCENDING)], name='due_date'),
+        # overdue scan ('flask apply-fines'): unpaid bills past their due date
+        IndexModel([('status', ASCENDING), ('due_date', ASCENDING)], name='status_due'),
+    ],
+    # batched agent payments ledger, one entry per idempotency key
+    'Payment': [IndexModel([('key', ASCENDING)], name='key_unique', unique=True)],
+}
+
+def index_targets():
+    """(db name, collection name, [IndexModel]) for every registered index."""
+    for col_name, models in ADMIN_INDEXES.items():
+        yield ADMIN_DB, col_name, models
+    for dbn in shard_db_names():
+        for col_name, models in SHARD_INDEXES.items():
+            yield dbn, col_name, models
+
+def ensure_indexes():
+    """Create any missing registered index. Returns a list of (db, col, error)."""
+    problems = []
+    if get_client() is None:
+        return problems
+    for dbn, col_name, models in index_targets():
+        try:
+            get_client()[dbn][col_name].create_indexes(models)
+        except Exception as e:
+            # e.g. duplicate ids already stored under a unique index
+            problems.append((dbn, col_name, str(e)))
+    return problems
+
+def index_report():
+    """Registered indexes that are missing and existing ones that look unused.
+
+    An index is reported unused when it is not in the registry or when
+    $indexStats shows no accesses since the server started.
+    """
+    missing = []
+    unused = []
+    if get_client() is None:
+        return missing, unused
+    for dbn, col_name, models in index_targets():
+        col = get_client()[dbn][col_name]
+        wanted = {m.document['name'] for m in models}
+        try:
+            existing = set(col.index_information())
+        except Exception:
+            existing = set()
+        try:
+            ops = {st['name']: st['accesses']['ops'] for st in col.aggregate([{'$indexStats': {}}])}
+        except Exception:
+            ops = {}
+        for name in sorted(wanted - existing):
+            missing.append((dbn, col_name, name))
+        for name in sorted(existing - {'_id_'}):
+            if name not in wanted or ops.get(name, 0) == 0:
+                unused.append((dbn, col_name, name))
+    return missing, unused
+
+def _ensure_indexes_bg():
+    # started by get_client() once per process when ENSURE_INDEXES is on
+    for dbn, col_name, err in ensure_indexes():
+        print(f"WARNING: could not create indexes on {dbn}.{col_name}:", err)
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create all registered indexes on managementdb and every shard."""
+    problems = ensure_indexes()
+    for dbn, col_name, err in problems:
+        click.echo(f"FAILED {dbn}.{col_name}: {err}")
+    click.echo("Indexes ensured" if not problems else f"{len(problems)} collection(s) failed")
+
+@app.cli.command('index-report')
+def index_report_command():
+    """List missing registered indexes and indexes with no recorded use."""
+    missing, unused = index_report()
+    for dbn, col_name, name in missing:
+        click.echo(f"missing  {dbn}.{col_name}.{name}")
+    for dbn, col_name, name in unused:
+        click.echo(f"unused   {dbn}.{col_name}.{name}")
+    if not missing and not unused:
+        click.echo("All registered indexes present and used")
+
+# ---- Meter number allocation ----
+# Hi/lo allocator: managementdb.counters holds one atomic sequence per meter
+# prefix, and each worker process takes METER_BLOCK_SIZE numbers at a time
+# with a single $inc, then hands them out locally. Numbers are unique across
+# all shards; a restarted worker leaves a gap, never a duplicate.
+_meter_blocks = {}
+_meter_blocks_pid = os.getpid()
+_meter_seeded = set()
+_meter_lock = threading.Lock()
+
+def meter_prefix(location: str) -> str:
+    prefix_map = {'dhaka': 'DH', 'rajshahi': 'RH', 'other': 'AL'}
+    return prefix_map.get((location or 'other').lower(), 'AL')
+
+def format_meter_no(prefix, number):
+    return f"{prefix}_{number:06d}"
+
+def _seed_meter_counter(prefix):
+    """Start the sequence above any meter number stored before it existed."""
+    if prefix in _meter_seeded:
+        return
+    last_number = 0
+    for dbn in shard_db_names():
+        try:
+            last = get_client()[dbn]['Meter_inf'].find_one({'meter_no': {'$regex': f'^{prefix}_'}},
+                                                     sort=[('meter_no', -1)])
+            if last:
+                last_number = max(last_number, int(last['meter_no'].split('_')[-1]))
+        except Exception:
+            continue
+    counters_coll().update_one({'_id': f'meter:{prefix}'}, {'$max': {'seq': last_number}}, upsert=True)
+    _meter_seeded.add(prefix)
+
+def reserve_meter_numbers(prefix, count):
+    """Atomically reserve count consecutive numbers; returns the first one."""
+    _seed_meter_counter(prefix)
+    doc = counters_coll().find_one_and_update(
+        {'_id': f'meter:{prefix}'},
+        {'$inc': {'seq': count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return doc['seq'] - count + 1
+
+def reserve_meter_block(prefix, count):
+    """Bulk reservation for mass onboarding: count formatted meter numbers."""
+    start = reserve_meter_numbers(prefix, count)
+    return [format_meter_no(prefix, n) for n in range(start, start + count)]
+
+def next_meter_no(prefix):
+    global _meter_blocks_pid
+    with _meter_lock:
+        if _meter_blocks_pid != os.getpid():
+            # forked worker: never reuse the parent's block
+            _meter_blocks.clear()
+            _meter_blocks_pid = os.getpid()
+        nxt, end = _meter_blocks.get(prefix, (0, 0))
+        if nxt >= end:
+            nxt = reserve_meter_numbers(prefix, METER_BLOCK_SIZE)
+            end = nxt + METER_BLOCK_SIZE
+        _meter_blocks[prefix] = (nxt + 1, end)
+    return format_meter_no(prefix, nxt)
+
+@app.cli.command('reserve-meters')
+@click.argument('location')
+@click.argument('count', type=int)
+def reserve_meters_command(location, count):
+    """Reserve COUNT meter numbers for LOCATION (dhaka/rajshahi/other)."""
+    meters = reserve_meter_block(meter_prefix(location), count)
+    click.echo(f"Reserved {meters[0]} .. {meters[-1]}")
+
+# ---- Password hashing policy ----
+# All hashing goes through hash_password()/verify_password() so the cost is
+# set in one place. When PASSWORD_HASH_METHOD changes, stored hashes are
+# upgraded on the next successful login. With PASSWORD_HASH_WORKERS > 0 the
+# hashing runs in a per-process pool of worker processes: that moves the CPU
+# work (and the GIL) off the web worker, but the request thread still waits
+# for the result. The pool is started with forkserver (spawn where that is
+# unavailable), never fork, since the parent already runs MongoClient threads.
+_hash_pool_state = {'pid': None, 'pool': None}
+
+def _policy_prefix(method):
+    # normalised "method:params" werkzeug writes before the first '$'
+    return generate_password_hash('x', method=method).split('$', 1)[0]
+
+PASSWORD_HASH_PREFIX = _policy_prefix(PASSWORD_HASH_METHOD)
+
+def _hash_pool():
+    if PASSWORD_HASH_WORKERS <= 0:
+        return None
+    if _hash_pool_state['pid'] != os.getpid():
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        _hash_pool_state['pool'] = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=context)
+        _hash_pool_state['pid'] = os.getpid()
+    return _hash_pool_state['pool']
+
+def hash_password(password):
+    """Hash with the current policy; blocks the calling thread until done."""
+    pool = _hash_pool()
+    if pool is None:
+        return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+    return pool.submit(generate_password_hash, password, PASSWORD_HASH_METHOD).result()
+
+def verify_password(pwhash, password):
+    """Check a password; blocks the calling thread until done."""
+    if not pwhash or password is None:
+        return False
+    pool = _hash_pool()
+    if pool is None:
+        return check_password_hash(pwhash, password)
+    return pool.submit(check_password_hash, pwhash, password).result()
+
+def needs_rehash(pwhash):
+    return bool(pwhash) and pwhash.split('$', 1)[0] != PASSWORD_HASH_PREFIX
+
+def hash_passwords(passwords):
+    """Hash many passwords in parallel (bulk onboarding)."""
+    pool = _hash_pool()
+    if pool is not None:
+        return list(pool.map(generate_password_hash, passwords, [PASSWORD_HASH_METHOD] * len(passwords)))
+    # hashlib releases the GIL, so threads hash in parallel too
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as threads:
+        return list(threads.map(lambda pw: generate_password_hash(pw, method=PASSWORD_HASH_METHOD), passwords))
+
+# ---- Identity directory ----
+# managementdb.identity maps a login id to its role, shard and password hash,
+# so login is one indexed lookup instead of probing admin, company and three
+# shard collections. Ids are only unique per region, so one id can have
+# several entries; login tries them in the old precedence order. The create/
+# update/delete routes keep it in sync and 'flask rebuild-identity' backfills.
+# Every change also appends the changed ids to managementdb.identity_changes
+# (expired by a TTL index); each worker reads the entries since its last look
+# at most every IDENTITY_CHANGES_POLL seconds and evicts just those ids, so a
+# deleted user or old password stops working in the other workers within
+# that time instead of IDENTITY_CACHE_TTL. Reads overlap by
+# IDENTITY_CHANGES_SLACK seconds to allow for clock skew between hosts.
+SHARD_ROLES = {'Agent': 'agent', 'Prepaid': 'customer_prepaid', 'Postpaid': 'customer_postpaid'}
+IDENTITY_CHANGES_POLL = float(os.getenv("IDENTITY_CHANGES_POLL", "1"))
+IDENTITY_CHANGES_SLACK = float(os.getenv("IDENTITY_CHANGES_SLACK", "5"))
+_identity_cache = OrderedDict()
+_identity_lock = threading.Lock()
+_identity_changes = {'since': None, 'checked_at': 0.0}
+
+def _identity_key(role, user_id, db_name=None):
+    return f"{role}:{db_name or ADMIN_DB}:{user_id}"
+
+def invalidate_identity(*user_ids):
+    """Drop ids from this process's LRU and log them for the other workers."""
+    with _identity_lock:
+        for user_id in user_ids:
+            _identity_cache.pop(user_id, None)
+    col = identity_changes_coll()
+    if col is None or not user_ids:
+        return
+    try:
+        col.insert_one({'ids': list(user_ids), 'at': datetime.utcnow()})
+    except Exception:
+        pass
+
+def _check_identity_changes():
+    """Evict ids other workers changed since this process last looked."""
+    now = time.time()
+    col = identity_changes_coll()
+    if col is None or now - _identity_changes['checked_at'] < IDENTITY_CHANGES_POLL:
+        return
+    _identity_changes['checked_at'] = now
+    since, started = _identity_changes['since'], datetime.utcnow()
+    if since is None:
+        # nothing cached yet in this process
+        _identity_changes['since'] = started
+        return
+    try:
+        changes = list(col.find({'at': {'$gte': since - timedelta(seconds=IDENTITY_CHANGES_SLACK)}}, {'ids': 1}))
+    except Exception:
+        return
+    with _identity_lock:
+        for change in changes:
+            for user_id in change.get('ids', []):
+                _identity_cache.pop(user_id, None)
+    _identity_changes['since'] = started
+
+def db_region(db_name):
+    """Region prefix ('Nesco', ...) of a shard database, from the shard map."""
+    for region in get_shard_map():
+        if db_name in region_db_names(region):
+            return region
+    return None
+
+def sync_identity(role, user_id, password=None, location=None, db_name=None):
+    """Upsert one directory entry; only the fields given are changed."""
+    col = identity_coll()
+    if col is None:
+        return
+    fields = {'id': user_id, 'role': role, 'db': db_name}
+    if password is not None:
+        fields['password'] = password
+    update = {'$set': fields}
+    if location is not None:
+        fields['location'] = location
+    elif db_name and db_region(db_name):
+        # shard users without a stored location: the shard's region
+        update['$setOnInsert'] = {'location': db_region(db_name).lower()}
+    try:
+        col.update_one({'_id': _identity_key(role, user_id, db_name)}, update, upsert=True)
+    except Exception:
+        pass
+    invalidate_identity(user_id)
+
+def remove_identity(user_id, roles, db_name=None):
+    col = identity_coll()
+    if col is None:
+        return
+    try:
+        col.delete_many({'_id': {'$in': [_identity_key(role, user_id, db_name) for role in roles]}})
+    except Exception:
+        pass
+    invalidate_identity(user_id)
+
+def lookup_identity(user_id):
+    """Directory entries for an id, through the in-process LRU."""
+    _check_identity_changes()
+    now = time.time()
+    with _identity_lock:
+        hit = _identity_cache.get(user_id)
+        if hit and now - hit[0] < IDENTITY_CACHE_TTL:
+            _identity_cache.move_to_end(user_id)
+            return hit[1]
+    col = identity_coll()
+    entries = list(col.find({'id': user_id})) if col is not None else []
+    with _identity_lock:
+        _identity_cache[user_id] = (now, entries)
+        _identity_cache.move_to_end(user_id)
+        while len(_identity_cache) > IDENTITY_CACHE_SIZE:
+            _identity_cache.popitem(last=False)
+    return entries
+
+def legacy_identities(user_id, location):
+    """Entries read from the source collections for ids not yet in the directory."""
+    entries = []
+    for role, col in (('admin', admin_coll()), ('company', company_coll())):
+        doc = col.find_one({'id': user_id}) if col is not None else None
+        if doc:
+            entries.append({'id': user_id, 'role': role, 'db': None,
+                            'location': doc.get('location'), 'password': doc.get('password', '')})
+    db = get_db_for_location(location, user_id)
+    for col_name, col in get_collections(db).items():
+        role = SHARD_ROLES.get(col_name)
+        doc = col.find_one({'id': user_id}) if role else None
+        if doc:
+            entries.append({'id': user_id, 'role': role, 'db': db.name,
+                            'location': doc.get('location', location), 'password': doc.get('password', '')})
+    for e in entries:
+        sync_identity(e['role'], user_id, e['password'], e['location'], e['db'])
+    return entries
+
+def _login_order(entries, chosen_db):
+    # admin, company, then the chosen shard's users, then other shards
+    roles = ['admin', 'company'] + list(SHARD_ROLES.values())
+    def key(e):
+        group = 0 if e['role'] in ('admin', 'company') else 1 if e.get('db') == chosen_db else 2
+        return group, roles.index(e['role']) if e['role'] in roles else len(roles)
+    return sorted(entries, key=key)
+
+def login_candidates(user_id, location):
+    """Yield credential entries in login precedence order.
+
+    Only ids with no directory entry at all are looked up in the source
+    collections (and added to the directory), so a wrong password costs one
+    lookup, never the old probes or a write.
+    """
+    chosen_db = choose_db(location, user_id)
+    entries = lookup_identity(user_id) or legacy_identities(user_id, location)
+    yield from _login_order(entries, chosen_db)
+
+def rehash_identity(entry, password):
+    """Store a hash under the current policy for a user who just logged in."""
+    new_hash = hash_password(password)
+    role = entry['role']
+    if role == 'admin':
+        col = admin_coll()
+    elif role == 'company':
+        col = company_coll()
+    else:
+        col_name = next(k for k, v in SHARD_ROLES.items() if v == role)
+        col = get_client()[entry['db']][col_name] if get_client() is not None else None
+    if col is None:
+        return
+    try:
+        col.update_one({'id': entry['id']}, {'$set': {'password': new_hash}})
+    except Exception:
+        return
+    sync_identity(role, entry['id'], new_hash, db_name=entry.get('db'))
+
+def rebuild_identity():
+    """Backfill the directory from admin, company and every shard."""
+    count = 0
+    for role, col in (('admin', admin_coll()), ('company', company_coll())):
+        for doc in col.find({}, {'id': 1, 'password': 1, 'location': 1}):
+            sync_identity(role, doc.get('id'), doc.get('password', ''), doc.get('location'))
+            count += 1
+    for dbn in shard_db_names():
+        cols = get_collections(get_client()[dbn])
+        for col_name, role in SHARD_ROLES.items():
+            for doc in cols[col_name].find({}, {'id': 1, 'password': 1, 'location': 1}):
+                sync_identity(role, doc.get('id'), doc.get('password', ''), doc.get('location'), dbn)
+                count += 1
+    return count
+
+@app.cli.command('rebuild-identity')
+def rebuild_identity_command():
+    """Backfill managementdb.identity from all credential collections."""
+    click.echo(f"Synced {rebuild_identity()} identities")
+
+# ---- Shard fan-out ----
+# One shared pool so a page touching N shards waits for the slowest shard,
+# not the sum of all of them. Long jobs (billing, deductions, payment
+# batches, fines, rebuilds, archiving) run on a second pool so they never
+# queue page queries behind them. A shard's timeout counts from when its
+# task starts running, not from when it was queued; a task still queued
+# after the timeout is cancelled, a running one is abandoned (threads
+# cannot be interrupted) and reported as failed.
+_shard_pool_state = {'pid': None, 'query': None, 'job': None}
+
+def _shard_pool(kind='query'):
+    # per process, like the client: a forked child must not reuse the parent's threads
+    if _shard_pool_state['pid'] != os.getpid():
+        _shard_pool_state['query'] = ThreadPoolExecutor(max_workers=SHARD_QUERY_WORKERS, thread_name_prefix="shard")
+        _shard_pool_state['job'] = ThreadPoolExecutor(max_workers=SHARD_JOB_WORKERS, thread_name_prefix="shard-job")
+        _shard_pool_state['pid'] = os.getpid()
+    return _shard_pool_state[kind]
+
+def wait_shards(futures, timeout):
+    """Wait for submit_shard() futures, each bounded by timeout from its own start."""
+    queued_at = time.monotonic()
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        deadlines = []
+        for fut in list(pending):
+            started = fut.started.get('at')
+            if fut.done():
+                pending.discard(fut)
+            elif started is None and now - queued_at >= timeout and fut.cancel():
+                pending.discard(fut)
+            elif started is not None and now - started >= timeout:
+                pending.discard(fut)
+            else:
+                deadlines.append((started if started is not None else queued_at) + timeout)
+        if pending:
+            wait(pending, timeout=max(min(deadlines) - now, 0), return_when=FIRST_COMPLETED)
+
+def fan_out(prefix, query, timeout=None, aquery=None, job=False):
+    """Run query(cols) on every shard of a region in parallel.
+
+    Returns (results, failed): results maps db name -> query result for the
+    shards that answered in time (in shard order), failed lists the db names
+    that raised or timed out so the caller can report partial data.
+    In async mode, aquery (a coroutine function taking async collections)
+    is used instead when given. job=True runs the queries on the long-job pool.
+    """
+    if get_client() is None:
+        return {}, []
+    timeout = SHARD_QUERY_TIMEOUT if timeout is None else timeout
+    if aquery is not None and async_mode():
+        # _afan_out bounds each shard by timeout and reports the slow ones;
+        # the outer wait only guards against a stuck event loop
+        return run_async(_afan_out(prefix, aquery, timeout), timeout + ASYNC_WAIT_SLACK)
+    futures = {}
+    for dbn in region_db_names(prefix):
+        futures[dbn] = submit_shard(query, get_collections(get_client()[dbn]), job=job)
+    wait_shards(futures.values(), timeout)
+
+    results = {}
+    failed = []
+    for dbn, fut in futures.items():
+        if not fut.done():
+            failed.append(dbn)
+            continue
+        try:
+            results[dbn] = fut.result()
+        except Exception:
+            failed.append(dbn)
+    return results, failed
+
+def fan_out_list(prefix, query, timeout=None, aquery=None):
+    """fan_out() for queries returning lists; merges them in shard order."""
+    results, failed = fan_out(prefix, query, timeout, aquery)
+    merged = []
+    for rows in results.values():
+        merged.extend(rows or [])
+    return merged, failed
+
+# ---- Async I/O mode ----
+# With ASYNC_MONGO=1 the fan-out routes send their shard queries through one
+# AsyncMongoClient running on a single event-loop thread per process: every
+# shard query of every request is multiplexed there, instead of occupying a
+# _shard_pool thread each. The app stays WSGI, so each request still holds its
+# own WSGI thread, blocked in run_async() until the gathered result arrives;
+# what async mode saves is the N pool threads (and pooled sockets) per
+# request, not the request thread itself.
+ASYNC_WAIT_SLACK = 5.0
+_aio = {'pid': None, 'loop': None, 'client': None}
+_aio_lock = threading.Lock()
+
+def async_mode():
+    return ASYNC_MONGO and AsyncMongoClient is not None
+
+def _aio_loop():
+    with _aio_lock:
+        if _aio['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="mongo-aio", daemon=True).start()
+            _aio.update(pid=os.getpid(), loop=loop,
+                        client=AsyncMongoClient(MONGO_URI, **mongo_client_options()))
+    return _aio['loop']
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the I/O loop; blocks the calling (request) thread until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _aio_loop()).result(timeout)
+
+async def _afan_out(prefix, aquery, timeout):
+    names = region_db_names(prefix)
+    aclient = _aio['client']
+    outcomes = await asyncio.gather(
+        *(asyncio.wait_for(aquery(get_collections(aclient[dbn])), timeout) for dbn in names),
+        return_exceptions=True
+    )
+    results = {}
+    failed = []
+    for dbn, outcome in zip(names, outcomes):
+        if isinstance(outcome, BaseException):
+            failed.append(dbn)
+        else:
+            results[dbn] = outcome
+    return results, failed
+
+if ASYNC_MONGO and AsyncMongoClient is None:
+    print("WARNING: ASYNC_MONGO=1 needs pymongo>=4.9 (AsyncMongoClient); using the thread pool")
+
+# ---- Keyset pagination across shards ----
+# Ids are unique within a region (choose_db routes by id), so ordering every
+# shard by id and merging gives one stable order; the cursor is the last id.
+# Bills sort on _id instead (many bills per id, ObjectIds are unique).
+def search_filter(q):
+    q = (q or '').strip()
+    if not q:
+        return {}
+    if q.isdigit():
+        return {'id': int(q)}
+    return {'name': {'$regex': '^' + re.escape(q), '$options': 'i'}}
+
+def page_query(col, filt, after=None, limit=PAGE_SIZE, projection=None, count=True,
+               sort_key='id', descending=False):
+    """One shard's slice of a keyset page: up to limit+1 rows after the cursor.
+
+    The total is the collection's estimated count when unfiltered, else the
+    matches counted up to PAGE_COUNT_LIMIT, so no page scans a whole shard.
+    """
+    if col is None:
+        return [], 0
+    query = _keyset_filter(filt, after, sort_key, descending)
+    rows = list(col.find(query, projection).sort(sort_key, -1 if descending else 1).limit(limit + 1))
+    if not count:
+        total = 0
+    elif not filt:
+        total = col.estimated_document_count()
+    else:
+        total = col.count_documents(filt, limit=PAGE_COUNT_LIMIT)
+    return rows, total
+
+async def apage_query(col, filt, after=None, limit=PAGE_SIZE, projection=None, count=True,
+                      sort_key='id', descending=False):
+    """page_query() for async collections."""
+    if col is None:
+        return [], 0
+    query = _keyset_filter(filt, after, sort_key, descending)
+    cursor = col.find(query, projection).sort(sort_key, -1 if descending else 1).limit(limit + 1)
+    rows = await cursor.to_list(None)
+    if not count:
+        total = 0
+    elif not filt:
+        total = await col.estimated_document_count()
+    else:
+        total = await col.count_documents(filt, limit=PAGE_COUNT_LIMIT)
+    return rows, total
+
+def _keyset_filter(filt, after, sort_key, descending):
+    if after is None:
+        return filt
+    past = {sort_key: {'$lt' if descending else '$gt': after}}
+    return {'$and': [filt, past]} if filt else past
+
+def merge_pages(shard_pages, limit=PAGE_SIZE, sort_key='id', descending=False):
+    """Merge per-shard page_query() results into (rows, next_cursor, total)."""
+    merged = heapq.merge(*(rows for rows, _ in shard_pages), key=lambda d: d.get(sort_key) or 0,
+                         reverse=descending)
+    rows = list(islice(merged, limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].get(sort_key)
+    return rows, next_cursor, sum(total for _, total in shard_pages)
+
+def paginate_shards(prefix, col_name, filt, after=None, limit=PAGE_SIZE, projection=None, count=True,
+                    sort_key='id', descending=False):
+    """Keyset page of one collection over all shards of a region."""
+    def load(cols):
+        return page_query(cols.get(col_name), filt, after, limit, projection, count, sort_key, descending)
+
+    async def aload(cols):
+        return await apage_query(cols.get(col_name), filt, after, limit, projection, count, sort_key, descending)
+
+    results, failed = fan_out(prefix, load, aquery=aload)
+    rows, next_cursor, total = merge_pages(list(results.values()), limit, sort_key, descending)
+    return rows, next_cursor, total, failed
+
+BILL_LIST_FIELDS = {'_id': 1, 'id': 1, 'amount': 1, 'status': 1, 'due_date': 1}
+
+def bill_search_filter(args):
+    """Bill filter from request args: id, status, due_from/due_to, min/max amount."""
+    filt = {}
+    user_id = args.get('id', type=int)
+    if user_id is not None:
+        filt['id'] = user_id
+    if args.get('status'):
+        filt['status'] = args['status']
+    due = {}
+    if parse_due_date(args.get('due_from')):
+        due['$gte'] = parse_due_date(args['due_from'])
+    if parse_due_date(args.get('due_to')):
+        due['$lte'] = parse_due_date(args['due_to'])
+    if due:
+        filt['due_date'] = due
+    amount = {}
+    if args.get('min_amount', type=float) is not None:
+        amount['$gte'] = args.get('min_amount', type=float)
+    if args.get('max_amount', type=float) is not None:
+        amount['$lte'] = args.get('max_amount', type=float)
+    if amount:
+        filt['amount'] = amount
+    return filt
+
+def object_id_or_none(value):
+    try:
+        return ObjectId(value) if value else None
+    except (InvalidId, TypeError):
+        return None
+
+def page_url(**changes):
+    """Current URL with some query args replaced (None drops the arg)."""
+    args = request.args.to_dict()
+    args.update(changes)
+    args = {k: v for k, v in args.items() if v not in (None, '')}
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+def history_requested():
+    return request.args.get('history') in ('1', 'true', 'yes')
+
+def flash_partial(failed):
+    if failed:
+        flash("Some shards did not respond, results are partial: " + ", ".join(failed), "error")
+
+# ---- Shard statistics (admin summary) ----
+# The admin page reads a cached snapshot; a background thread refreshes it
+# once it is older than SHARD_STATS_TTL. Counts come from collection metadata
+# (estimated_document_count) unless SHARD_STATS_EXACT=1.
+_shard_stats = {'summary': [], 'refreshed_at': 0.0, 'refreshing': False}
+_shard_stats_lock = threading.Lock()
+
+def _count(col):
+    if col is None:
+        return 0
+    try:
+        return col.count_documents({}) if SHARD_STATS_EXACT else col.estimated_document_count()
+    except Exception:
+        return 0
+
+def shard_db_stats(dbn):
+    db = get_client()[dbn]
+    cols = get_collections(db)
+    users = sum(_count(cols.get(k)) for k in ('Agent', 'Prepaid', 'Postpaid'))
+    bills = _count(cols.get('Bill'))
+    try:
+        size = db.command('dbStats').get('dataSize', 0)
+    except Exception:
+        size = 0
+    return {'db': dbn, 'users': users, 'bills': bills, 'size': size}
+
+def refresh_shard_stats():
+    """Recount every shard in parallel and record a snapshot with growth."""
+    if get_client() is None:
+        return []
+    db_names = shard_db_names()
+    futures = [submit_shard(shard_db_stats, dbn) for dbn in db_names]
+    wait_shards(futures, SHARD_QUERY_TIMEOUT)
+    previous = {s['db']: s for s in _shard_stats['summary']}
+    summary = []
+    for dbn, fut in zip(db_names, futures):
+        try:
+            row = fut.result(timeout=0)
+        except Exception:
+            row = {'db': dbn, 'users': 0, 'bills': 0, 'size': 0}
+        prev = previous.get(dbn)
+        row['users_growth'] = row['users'] - prev['users'] if prev else 0
+        row['bills_growth'] = row['bills'] - prev['bills'] if prev else 0
+        summary.append(row)
+
+    now = time.time()
+    try:
+        get_client()[ADMIN_DB]['shard_stats'].insert_one({'at': datetime.utcnow(), 'shards': summary})
+    except Exception:
+        pass
+    with _shard_stats_lock:
+        _shard_stats['summary'] = [dict(row) for row in summary]
+        _shard_stats['refreshed_at'] = now
+        _shard_stats['refreshing'] = False
+    return summary
+
+def _refresh_shard_stats_bg():
+    try:
+        refresh_shard_stats()
+    finally:
+        _shard_stats['refreshing'] = False
+
+def get_shard_stats():
+    """Cached summary; stale data is served while a refresh runs in the background."""
+    with _shard_stats_lock:
+        summary = _shard_stats['summary']
+        refreshed_at = _shard_stats['refreshed_at']
+        stale = time.time() - refreshed_at > SHARD_STATS_TTL
+        start = stale and summary and not _shard_stats['refreshing']
+        if start:
+            _shard_stats['refreshing'] = True
+    if not summary:
+        # first load: nothing cached yet
+        return refresh_shard_stats(), time.time()
+    if start:
+        threading.Thread(target=_refresh_shard_stats_bg, daemon=True).start()
+    return summary, refreshed_at
+
+# ---- Account summaries ----
+# One small document per postpaid customer in each shard's Account collection
+# (_id = customer id): the profile fields list pages show, the latest bill and
+# what is outstanding on it. Bill creation and payments update it right after
+# their own write, profile changes upsert it, and 'flask rebuild-accounts'
+# rebuilds or verifies it from Postpaid and Bill. A shard's list pages read
+# Account only once a rebuild has filled it (managementdb.accounts_ready);
+# until then they read Postpaid and Bill, without writing anything.
+IN_QUERY_BATCH = 5000
+ACCOUNT_PROFILE_FIELDS = ('id', 'name', 'meter_no', 'location')
+LAST_BILL_FIELDS = ('_id', 'amount', 'status', 'due_date', 'period', 'fine', 'base_amount', 'previous_due')
+ACCOUNT_PROJECTION = dict.fromkeys(ACCOUNT_PROFILE_FIELDS, 1)
+OUTSTANDING_FIELDS = {'_id': 0, 'id': 1, 'name': 1, 'meter_no': 1, 'location': 1, 'outstanding': 1, 'fine': 1}
+_accounts_ready = set()  # shards whose Account collection a rebuild has filled (per process)
+
+def _bill_state(bill):
+    """The summary fields that follow from a customer's latest bill."""
+    unpaid = bool(bill) and bill.get('status') == 'unpaid'
+    return {
+        'last_bill': {f: bill.get(f) for f in LAST_BILL_FIELDS if f in bill} if bill else None,
+        'outstanding': bill.get('amount', 0) if unpaid else 0,
+        'fine': bill.get('fine', 0) if unpaid else 0,
+    }
+
+def account_doc(user, last_bill):
+    """Full summary for a postpaid user document and their latest bill."""
+    return {'_id': user['id'], **{f: user.get(f) for f in ACCOUNT_PROFILE_FIELDS}, **_bill_state(last_bill)}
+
+def account_profile_op(user):
+    """Upsert of the profile part, leaving the bill state alone."""
+    return UpdateOne({'_id': user['id']},
+                     {'$set': {f: user.get(f) for f in ACCOUNT_PROFILE_FIELDS},
+                      '$setOnInsert': _bill_state(None)}, upsert=True)
+
+def account_bill_op(user, bill):
+    """Point the summary at a newly inserted bill, unless a newer one is already there."""
+    return UpdateOne({'_id': bill['id'], '$or': [{'last_bill': None}, {'last_bill._id': {'$lt': bill['_id']}}]},
+                     {'$set': {**_bill_state(bill), 'updated_at': datetime.utcnow()},
+                      '$setOnInsert': {f: user.get(f) for f in ACCOUNT_PROFILE_FIELDS}}, upsert=True)
+
+def account_paid_op(user_id, bill_id):
+    """Mark the summary's bill paid, if it is still the latest one."""
+    return UpdateOne({'_id': user_id, 'last_bill._id': bill_id},
+                     {'$set': {'last_bill.status': 'paid', 'outstanding': 0, 'fine': 0,
+                               'updated_at': datetime.utcnow()}})
+
+def write_accounts(cols, ops):
+    """Apply summary updates; a guard that lost a race to a newer bill is not an error."""
+    if not ops or cols.get('Account') is None:
+        return
+    try:
+        cols['Account'].bulk_write(ops, ordered=False)
+    except errors.BulkWriteError as e:
+        if any(err['code'] != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+
+def _accounts_ready_coll(cols):
+    return cols['Account'].database.client[ADMIN_DB]['accounts_ready']
+
+def postpaid_outstanding(cols, after=None, limit=None):
+    """Outstanding/fine rows for the postpaid users of one shard, in id order.
+
+    Read from Account once 'flask rebuild-accounts' has filled it, else
+    computed from Postpaid and Bill (read-only). With limit, one keyset
+    page: up to limit+1 rows with id > after.
+    """
+    account_col, po_col = cols.get('Account'), cols.get('Postpaid')
+    if account_col is None:
+        return []
+    dbn = account_col.database.name
+    if dbn not in _accounts_ready:
+        if _accounts_ready_coll(cols).find_one({'_id': dbn}, {'_id': 1}) is None:
+            rows = []
+            for users in _postpaid_batches(po_col, after, limit + 1 if limit else None):
+                latest = latest_bills(cols['Bill'], [u['id'] for u in users])
+                rows += [_outstanding_row(account_doc(u, latest.get(u['id']))) for u in users]
+            return rows
+        _accounts_ready.add(dbn)
+    cursor = account_col.find({'_id': {'$gt': after}} if after is not None else {}, OUTSTANDING_FIELDS).sort('_id', 1)
+    return [_outstanding_row(a) for a in (cursor.limit(limit + 1) if limit else cursor)]
+
+async def apostpaid_outstanding(cols, after=None, limit=None):
+    """postpaid_outstanding() for async collections."""
+    account_col, po_col = cols.get('Account'), cols.get('Postpaid')
+    if account_col is None:
+        return []
+    dbn = account_col.database.name
+    if dbn not in _accounts_ready:
+        if await _accounts_ready_coll(cols).find_one({'_id': dbn}, {'_id': 1}) is None:
+            rows = []
+            last_id = after
+            while not limit or len(rows) <= limit:
+                query = {'id': {'$gt': last_id}} if last_id is not None else {}
+                size = min(IN_QUERY_BATCH, limit + 1 - len(rows)) if limit else IN_QUERY_BATCH
+                users = await po_col.find(query, ACCOUNT_PROJECTION).sort('id', 1).limit(size).to_list(None)
+                if not users:
+                    break
+                last_id = users[-1]['id']
+                latest = await alatest_bills(cols['Bill'], [u['id'] for u in users])
+                rows += [_outstanding_row(account_doc(u, latest.get(u['id']))) for u in users]
+            return rows
+        _accounts_ready.add(dbn)
+    cursor = account_col.find({'_id': {'$gt': after}} if after is not None else {}, OUTSTANDING_FIELDS).sort('_id', 1)
+    return [_outstanding_row(a) for a in await (cursor.limit(limit + 1) if limit else cursor).to_list(None)]
+
+def _postpaid_batches(po_col, after=None, limit=None):
+    """Postpaid profiles with id > after in IN_QUERY_BATCH keyset batches, up to limit in all."""
+    last_id, left = after, limit
+    while left is None or left > 0:
+        query = {'id': {'$gt': last_id}} if last_id is not None else {}
+        size = IN_QUERY_BATCH if left is None else min(IN_QUERY_BATCH, left)
+        users = list(po_col.find(query, ACCOUNT_PROJECTION).sort('id', 1).limit(size))
+        if not users:
+            return
+        last_id = users[-1]['id']
+        left = None if left is None else left - len(users)
+        yield users
+
+def _outstanding_row(account):
+    row = {k: account.get(k) for k in OUTSTANDING_FIELDS if k != '_id'}
+    return dict(row, outstanding=account.get('outstanding', 0), fine=account.get('fine', 0))
+
+def rebuild_accounts(cols, fix=True):
+    """Recompute every summary of one shard from Postpaid and Bill.
+
+    Returns counts of missing, stale and orphaned summaries; with fix they
+    are rewritten or removed, otherwise only reported. A fixed shard is
+    marked in managementdb.accounts_ready so list pages read Account.
+    """
+    po_col, account_col = cols['Postpaid'], cols['Account']
+    report = {'checked': 0, 'missing': 0, 'stale': 0, 'orphaned': 0}
+    last_id = None
+    while True:
+        query = {'id': {'$gt': last_id}} if last_id is not None else {}
+        users = list(po_col.find(query, ACCOUNT_PROJECTION).sort('id', 1).limit(IN_QUERY_BATCH))
+        if not users:
+            break
+        last_id = users[-1]['id']
+        ids = [user['id'] for user in users]
+        latest = latest_bills(cols['Bill'], ids)
+        stored = {a['_id']: a for a in account_col.find({'_id': {'$in': ids}}, {'updated_at': 0})}
+        ops = []
+        for user in users:
+            want = account_doc(user, latest.get(user['id']))
+            have = stored.get(user['id'])
+            if have == want:
+                continue
+            report['missing' if have is None else 'stale'] += 1
+            ops.append(ReplaceOne({'_id': user['id']}, dict(want, updated_at=datetime.utcnow()), upsert=True))
+        report['checked'] += len(users)
+        if fix and ops:
+            account_col.bulk_write(ops, ordered=False)
+
+    last_id = None
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        ids = [a['_id'] for a in account_col.find(query, {'_id': 1}).sort('_id', 1).limit(IN_QUERY_BATCH)]
+        if not ids:
+            break
+        last_id = ids[-1]
+        orphans = set(ids) - {u['id'] for u in po_col.find({'id': {'$in': ids}}, {'id': 1})}
+        report['orphaned'] += len(orphans)
+        if fix and orphans:
+            account_col.delete_many({'_id': {'$in': list(orphans)}})
+    if fix:
+        _accounts_ready_coll(cols).update_one({'_id': account_col.database.name},
+                                              {'$set': {'at': datetime.utcnow()}}, upsert=True)
+    return report
+
+@app.cli.command('rebuild-accounts')
+@click.option('--verify', is_flag=True, help='Only report differences, do not write.')
+def rebuild_accounts_command(verify):
+    """Rebuild (or with --verify, check) the Account summaries on every shard."""
+    for prefix in get_shard_map():
+        results, failed = fan_out(prefix, lambda cols: rebuild_accounts(cols, fix=not verify),
+                                  timeout=BILLING_TIMEOUT, job=True)
+        for dbn, report in results.items():
+            click.echo(f"{dbn}: " + ", ".join(f"{k} {v}" for k, v in report.items()))
+        for dbn in failed:
+            click.echo(f"{dbn}: FAILED")
+
+# ---- Shard rebalancing ----
+# Moves customers with ids low..high of one region from their current shard
+# to another: copy in batches (resumable), switch the shard map, copy again
+# to catch writes made before every worker saw the new map, then delete the
+# moved documents from the source. Progress lives in managementdb.migrations.
+# Copied documents carry a hash of the source version (MIGRATION_MARK) until
+# the move is done: the catch-up only replaces a target document the app has
+# not written since the copy, so writes routed to the target always win.
+MIGRATION_BATCH = int(os.getenv("MIGRATION_BATCH", "1000"))
+MIGRATION_MARK = '_migrated_hash'
+USER_COLLECTIONS = ('Agent', 'Prepaid', 'Postpaid', 'Bill', 'Payment', 'Account')
+
+def migrations_coll():
+    return get_client()[ADMIN_DB]['migrations'] if get_client() is not None else None
+
+def reassign_range(cfg, low, high, target):
+    """Range config with ids low..high routed to target."""
+    if cfg['strategy'] != 'range':
+        raise ValueError("only range-routed regions can move an id range")
+    ranges = []
+    for a, b, dbn in cfg['ranges']:
+        if b < low or a > high:
+            ranges.append([a, b, dbn])
+            continue
+        if a < low:
+            ranges.append([a, low - 1, dbn])
+        if b > high:
+            ranges.append([high + 1, b, dbn])
+    ranges.append([low, high, target])
+    return dict(cfg, ranges=sorted(ranges))
+
+def range_source(prefix, low, high):
+    """The one shard currently holding ids low..high."""
+    cfg = get_shard_map()[prefix]
+    if cfg['strategy'] != 'range':
+        raise ValueError("only range-routed regions can move an id range")
+    sources = {dbn for a, b, dbn in cfg['ranges'] if not (b < low or a > high)}
+    covered = sum(min(b, high) - max(a, low) + 1 for a, b, _ in cfg['ranges'] if not (b < low or a > high))
+    if covered < high - low + 1 and cfg.get('fallback'):
+        sources.add(cfg['fallback'])
+    if len(sources) != 1:
+        raise ValueError(f"ids {low}-{high} span several shards: {', '.join(sorted(sources))}")
+    return sources.pop()
+
+def _doc_hash(doc):
+    return hashlib.sha1(bson.encode({k: v for k, v in doc.items() if k != MIGRATION_MARK})).hexdigest()
+
+def _catch_up_ops(batch, dst_col, copied_upto):
+    """Writes that bring dst_col up to date with source changes, never over newer target writes."""
+    targets = {t['_id']: t for t in dst_col.find({'_id': {'$in': [d['_id'] for d in batch]}})}
+    ops = []
+    for d in batch:
+        h = _doc_hash(d)
+        t = targets.get(d['_id'])
+        if t is None:
+            if copied_upto is not None and d['_id'] <= copied_upto:
+                continue  # copied, then deleted on the target after the switch
+            ops.append(UpdateOne({'_id': d['_id']},
+                                 {'$setOnInsert': {**{k: v for k, v in d.items() if k != '_id'},
+                                                   MIGRATION_MARK: h}}, upsert=True))
+        elif t.get(MIGRATION_MARK) == h or _doc_hash(t) != t.get(MIGRATION_MARK):
+            continue  # source unchanged, or the target was written after the switch
+        else:
+            # filtering on the whole target document loses to a concurrent write
+            ops.append(ReplaceOne(t, dict(d, **{MIGRATION_MARK: h})))
+    return ops
+
+def _copy_batches(src_col, dst_col, query, job_id, key, catch_up=False, copied_upto=None):
+    """Copy every matching document into dst_col, checkpointing by _id.
+
+    The first pass replaces target documents outright (nothing is routed to
+    the target yet); with catch_up only source changes the target has not
+    overwritten are applied, and documents at or below copied_upto that are
+    missing on the target are taken as deleted there.
+    """
+    jobs = migrations_coll()
+    job = jobs.find_one({'_id': job_id}) or {}
+    last_id = job.get('checkpoints', {}).get(key)
+    copied = 0
+    while True:
+        q = dict(query)
+        if last_id is not None:
+            q['_id'] = {'$gt': last_id}
+        batch = list(src_col.find(q).sort('_id', 1).limit(MIGRATION_BATCH))
+        if not batch:
+            return copied
+        if catch_up:
+            ops = _catch_up_ops(batch, dst_col, copied_upto)
+        else:
+            ops = [ReplaceOne({'_id': d['_id']}, dict(d, **{MIGRATION_MARK: _doc_hash(d)}), upsert=True)
+                   for d in batch]
+        if ops:
+            dst_col.bulk_write(ops, ordered=False)
+        last_id = batch[-1]['_id']
+        copied += len(batch)
+        jobs.update_one({'_id': job_id}, {'$set': {f'checkpoints.{key}': last_id},
+                                          '$inc': {f'copied.{key}': len(batch)}})
+
+def _meter_numbers(cols, query):
+    meters = set()
+    for col_name in ('Prepaid', 'Postpaid'):
+        for d in cols[col_name].find(query, {'meter_no': 1}):
+            if d.get('meter_no'):
+                meters.add(d['meter_no'])
+    return sorted(meters)
+
+def _copy_range(src, dst, query, job_id, pass_name):
+    catch_up = pass_name == 'catchup'
+    checkpoints = (migrations_coll().find_one({'_id': job_id}) or {}).get('checkpoints', {})
+    collections = [(src[col_name], dst[col_name], col_name) for col_name in USER_COLLECTIONS]
+    collections += [(archive, dst['Bill'].database[archive.name], archive.name)
+                    for archive in archive_collections(src['Bill'].database)]
+    counts = {}
+    for src_col, dst_col, name in collections:
+        counts[name] = _copy_batches(src_col, dst_col, query, job_id, f'{pass_name}_{name}',
+                                     catch_up, checkpoints.get(f'copy_{name}'))
+    meters = _meter_numbers(src, query)
+    counts['Meter_inf'] = 0
+    for i in range(0, len(meters), IN_QUERY_BATCH):
+        # meters are never deleted, so a missing one is always copied
+        counts['Meter_inf'] += _copy_batches(src['Meter_inf'], dst['Meter_inf'],
+                                             {'meter_no': {'$in': meters[i:i + IN_QUERY_BATCH]}},
+                                             job_id, f'{pass_name}_Meter_inf_{i}', catch_up)
+    return counts
+
+def _clear_marks(dst, query, meters):
+    for col_name in USER_COLLECTIONS:
+        dst[col_name].update_many(dict(query, **{MIGRATION_MARK: {'$exists': True}}),
+                                  {'$unset': {MIGRATION_MARK: ''}})
+    for archive in archive_collections(dst['Bill'].database):
+        archive.update_many(dict(query, **{MIGRATION_MARK: {'$exists': True}}), {'$unset': {MIGRATION_MARK: ''}})
+    for i in range(0, len(meters), IN_QUERY_BATCH):
+        dst['Meter_inf'].update_many({'meter_no': {'$in': meters[i:i + IN_QUERY_BATCH]},
+                                      MIGRATION_MARK: {'$exists': True}}, {'$unset': {MIGRATION_MARK: ''}})
+
+def _move_identities(source, target, low, high):
+    col = identity_coll()
+    for e in list(col.find({'db': source, 'id': {'$gte': low, '$lte': high}})):
+        sync_identity(e['role'], e['id'], e.get('password'), e.get('location'), target)
+        col.delete_one({'_id': e['_id']})
+
+def move_range(prefix, low, high, target, report=print):
+    """Move ids low..high of a region to target; re-running resumes a failed move."""
+    jobs = migrations_coll()
+    job = jobs.find_one({'prefix': prefix, 'low': low, 'high': high, 'target': target,
+                         'phase': {'$ne': 'done'}})
+    if job is None:
+        source = range_source(prefix, low, high)
+        if source == target:
+            raise ValueError(f"ids {low}-{high} already live on {target}")
+        job = {'_id': f"{prefix}:{low}-{high}:{source}->{target}", 'prefix': prefix, 'low': low,
+               'high': high, 'source': source, 'target': target, 'phase': 'copy',
+               'started_at': datetime.utcnow()}
+        jobs.replace_one({'_id': job['_id']}, job, upsert=True)
+    job_id, source = job['_id'], job['source']
+    for col_name, models in SHARD_INDEXES.items():
+        get_client()[target][col_name].create_indexes(models)
+    src = get_collections(get_client()[source])
+    dst = get_collections(get_client()[target])
+    query = {'id': {'$gte': low, '$lte': high}}
+    start = time.perf_counter()
+
+    if job['phase'] == 'copy':
+        counts = _copy_range(src, dst, query, job_id, 'copy')
+        total = sum(counts.values())
+        report(f"copied {total} docs {counts} at {total / max(time.perf_counter() - start, 1e-9):.0f} docs/s")
+
+        regions = get_shard_map()
+        regions = dict(regions, **{prefix: reassign_range(regions[prefix], low, high, target)})
+        version = save_shard_map(regions)
+        _move_identities(source, target, low, high)
+        jobs.update_one({'_id': job_id}, {'$set': {'phase': 'switched', 'version': version}})
+        report(f"routing for {prefix} {low}-{high} switched to {target} (shard map v{version})")
+
+        # writes routed to the source before every worker reloaded the map
+        time.sleep(SHARD_MAP_TTL)
+
+    counts = _copy_range(src, dst, query, job_id, 'catchup')
+    report(f"catch-up checked {sum(counts.values())} docs")
+
+    meters = _meter_numbers(src, query)
+    _clear_marks(dst, query, meters)
+    for col_name in USER_COLLECTIONS:
+        src[col_name].delete_many(query)
+    for archive in archive_collections(src['Bill'].database):
+        archive.delete_many(query)
+    for i in range(0, len(meters), IN_QUERY_BATCH):
+        src['Meter_inf'].delete_many({'meter_no': {'$in': meters[i:i + IN_QUERY_BATCH]}})
+    elapsed = time.perf_counter() - start
+    jobs.update_one({'_id': job_id}, {'$set': {'phase': 'done', 'finished_at': datetime.utcnow()}})
+    report(f"cleaned up {source}; done in {elapsed:.1f}s")
+    return job_id
+
+@app.cli.command('move-range')
+@click.argument('region')
+@click.argument('low', type=int)
+@click.argument('high', type=int)
+@click.argument('target')
+def move_range_command(region, low, high, target):
+    """Move ids LOW..HIGH of REGION (Nesco/Desco/PBS) to the TARGET shard."""
+    try:
+        move_range(region, low, high, target, report=click.echo)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+# ---- Tariffs ----
+# Slab rates per region and customer type, stored in managementdb.tariffs
+# (_id "current") and cached per process for TARIFF_TTL seconds. Each slab is
+# [upper unit bound or null, rate per unit]; units in a slab are charged at its
+# rate and 'fixed' is added once. Charges for a whole batch of meters are
+# computed with NumPy array arithmetic when it is installed, else per meter.
+# A meter's unit_usage is its running total (the latest reading); postpaid
+# bills and prepaid deductions charge only the units above the mark kept on
+# the customer (billed_units on Postpaid, charged_units on Prepaid) and move
+# the mark to the reading they charged.
+TARIFF_TTL = float(os.getenv("TARIFF_TTL", "60"))
+_DEFAULT_SLABS = [[75, 5.26], [200, 7.20], [300, 7.59], [400, 8.02], [600, 12.67], [None, 14.61]]
+DEFAULT_TARIFFS = {
+    region: {
+        'postpaid': {'fixed': 42.0, 'slabs': _DEFAULT_SLABS},
+        'prepaid': {'fixed': 35.0, 'slabs': [[bound, round(rate * 0.99, 4)] for bound, rate in _DEFAULT_SLABS]},
+    }
+    for region in REGIONS
+}
+_tariffs = {'regions': DEFAULT_TARIFFS, 'checked_at': 0.0}
+
+def tariffs_coll():
+    return get_client()[ADMIN_DB]['tariffs'] if get_client() is not None else None
+
+def get_tariff(prefix, customer_type):
+    """Tariff for a region prefix and 'prepaid'/'postpaid', refreshed every TARIFF_TTL."""
+    col = tariffs_coll()
+    if col is not None and time.time() - _tariffs['checked_at'] >= TARIFF_TTL:
+        _tariffs['checked_at'] = time.time()
+        try:
+            doc = col.find_one({'_id': 'current'})
+            _tariffs['regions'] = doc['regions'] if doc else DEFAULT_TARIFFS
+        except Exception:
+            pass
+    region = _tariffs['regions'].get(prefix) or DEFAULT_TARIFFS['PBS']
+    return region.get(customer_type) or region['postpaid']
+
+def save_tariffs(regions):
+    for region, types in regions.items():
+        for customer_type, tariff in types.items():
+            bounds = [b for b, _ in tariff['slabs']]
+            if not bounds or bounds[-1] is not None or None in bounds[:-1] or bounds[:-1] != sorted(bounds[:-1]):
+                raise ValueError(f"{region}/{customer_type}: slab bounds must ascend and end with null")
+    tariffs_coll().replace_one({'_id': 'current'}, {'_id': 'current', 'regions': regions}, upsert=True)
+    _tariffs.update(regions=regions, checked_at=time.time())
+
+def slab_charges(units, tariff):
+    """Charge for every usage in units (a sequence), as a list of floats."""
+    fixed = float(tariff.get('fixed', 0))
+    if np is None:
+        return [_slab_charge(u, tariff['slabs']) + fixed for u in units]
+    usage = np.maximum(np.asarray(units, dtype=np.float64), 0)
+    total = np.full(usage.shape, fixed)
+    lower = 0.0
+    for upper, rate in tariff['slabs']:
+        band = usage - lower if upper is None else np.clip(usage - lower, 0, upper - lower)
+        total += np.maximum(band, 0) * rate
+        if upper is None:
+            break
+        lower = float(upper)
+    return np.round(total, 2).tolist()
+
+def _slab_charge(units, slabs):
+    units = max(float(units or 0), 0.0)
+    total = 0.0
+    lower = 0.0
+    for upper, rate in slabs:
+        if units <= lower:
+            break
+        total += ((units if upper is None else min(units, upper)) - lower) * rate
+        if upper is None:
+            break
+        lower = float(upper)
+    return round(total, 2)
+
+def meter_usage(cols, meter_nos):
+    """meter_no -> unit_usage for a batch of meters, one $in query per IN_QUERY_BATCH."""
+    usage = {}
+    meter_col = cols.get('Meter_inf')
+    if meter_col is None:
+        return usage
+    for i in range(0, len(meter_nos), IN_QUERY_BATCH):
+        for m in meter_col.find({'meter_no': {'$in': meter_nos[i:i + IN_QUERY_BATCH]}},
+                                {'_id': 0, 'meter_no': 1, 'unit_usage': 1}):
+            usage[m['meter_no']] = m.get('unit_usage') or 0
+    return usage
+
+def tariff_charges(users, units, customer_type):
+    """Slab charge of units[i] for users[i], one vectorized pass per region in the batch."""
+    charges = [0.0] * len(users)
+    groups = {}
+    for i, u in enumerate(users):
+        groups.setdefault(region_prefix(u.get('location')), []).append(i)
+    for prefix, idx in groups.items():
+        for i, charge in zip(idx, slab_charges([units[i] for i in idx], get_tariff(prefix, customer_type))):
+            charges[i] = charge
+    return charges
+
+def unbilled_usage(cols, users, mark):
+    """(meter readings, units above each user's mark field) for a batch of users."""
+    usage = meter_usage(cols, [u['meter_no'] for u in users if u.get('meter_no')])
+    readings = [usage.get(u.get('meter_no'), 0) for u in users]
+    return readings, [max(r - (u.get(mark) or 0), 0) for u, r in zip(users, readings)]
+
+def tariff_amounts(customer_type):
+    """Batch amount function for bill_shard(): slab charge on each user's unbilled units."""
+    def amounts_for(cols, users, units):
+        return tariff_charges(users, units, customer_type)
+    return amounts_for
+
+@app.cli.command('load-tariffs')
+@click.argument('path', type=click.Path(exists=True))
+def load_tariffs_command(path):
+    """Replace the slab tariffs with the JSON file at PATH ({region: {type: tariff}})."""
+    with open(path) as f:
+        regions = json.load(f)
+    try:
+        save_tariffs(regions)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo("Tariffs saved")
+
+# ---- Billing ----
+BILL_FINE = 50
+BILLING_TIMEOUT = float(os.getenv("BILLING_TIMEOUT", "3600"))
+
+def parse_due_date(value):
+    """A stored due date as a datetime: accepts datetimes and ISO strings, else None."""
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).strip()) if value else None
+    except ValueError:
+        return None
+
+def carry_forward(old_bill):
+    """(previous amount, late fine included in it) carried into the next bill."""
+    if not old_bill:
+        return 0, 0
+    old_amount = float(old_bill.get("amount", 0) or 0)
+    # late fines are added to the bill itself by 'flask apply-fines'
+    fine = old_bill.get("fine", 0) if old_bill.get("status") == "unpaid" else 0
+    return old_amount, fine
+
+def build_bill(user_id, location, new_amount, due_date, old_bill):
+    old_amount, _ = carry_forward(old_bill)
+    new_bill = {
+        "id": user_id,
+        "location": location,
+        "amount": new_amount + old_amount,
+        "due_date": parse_due_date(due_date),
+        "status": "unpaid",
+        "fine": 0,
+        "base_amount": new_amount,
+        "previous_due": old_amount
+    }
+    if old_bill and old_bill.get("status") == "unpaid":
+        new_bill["replaces"] = old_bill["_id"]
+    return new_bill
+
+def _latest_bills_pipeline(ids):
+    return [
+        {'$match': {'id': {'$in': ids}}},
+        {'$sort': {'id': 1, '_id': -1}},
+        {'$group': {'_id': '$id', 'bill': {'$first': '$$ROOT'}}},
+    ]
+
+def latest_bills(bill_col, ids):
+    """Latest bill per user id for a batch of ids, in one aggregation."""
+    return {row['_id']: row['bill'] for row in bill_col.aggregate(_latest_bills_pipeline(ids))}
+
+async def alatest_bills(bill_col, ids):
+    """latest_bills() for async collections."""
+    cursor = await bill_col.aggregate(_latest_bills_pipeline(ids))
+    return {row['_id']: row['bill'] for row in await cursor.to_list(None)}
+
+def billed_mark_op(user_id, reading):
+    """Move a postpaid customer's billed_units mark up to a billed meter reading."""
+    return UpdateOne({'id': user_id}, {'$max': {'billed_units': reading}})
+
+def bill_shard(cols, period, due_date, amounts_for):
+    """Bill every postpaid customer of one shard for a period.
+
+    Customers that already have a bill for the period are skipped, so a
+    run can be repeated safely, also after later bills were issued; the
+    unique {id, period} index backs this up. amounts_for(cols, users, units)
+    returns the new base amount of each user in a batch, given the units
+    above its billed_units mark; the mark moves to the billed meter reading
+    in the same batch as the bill insert.
+    """
+    po_col, bill_col = cols['Postpaid'], cols['Bill']
+    billed = skipped = 0
+    last_id = None
+    while True:
+        query = {'id': {'$gt': last_id}} if last_id is not None else {}
+        users = list(po_col.find(query, {'password': 0}).sort('id', 1).limit(IN_QUERY_BATCH))
+        if not users:
+            return {'billed': billed, 'skipped': skipped}
+        last_id = users[-1]['id']
+        ids = [user['id'] for user in users]
+        latest = latest_bills(bill_col, ids)
+        billed_ids = {d['id'] for d in bill_col.find({'id': {'$in': ids}, 'period': period}, {'id': 1})}
+
+        new_bills = []
+        replaced = []
+        accounts = []
+        marks = []
+        todo = []
+        for user in users:
+            old_bill = latest.get(user['id'])
+            if old_bill and old_bill.get('period') == period:
+                # billed by an earlier (possibly interrupted) run
+                if old_bill.get('replaces'):
+                    replaced.append(old_bill['replaces'])
+                accounts.append(account_bill_op(user, old_bill))
+                if old_bill.get('meter_reading') is not None:
+                    marks.append(billed_mark_op(user['id'], old_bill['meter_reading']))
+                skipped += 1
+                continue
+            if user['id'] in billed_ids:
+                # billed for the period, and newer bills exist since
+                skipped += 1
+                continue
+            todo.append(user)
+        readings, units = unbilled_usage(cols, todo, 'billed_units') if todo else ([], [])
+        amounts = amounts_for(cols, todo, units) if todo else []
+        for user, amount, reading in zip(todo, amounts, readings):
+            old_bill = latest.get(user['id'])
+            bill = build_bill(user['id'], user.get('location'), amount, due_date, old_bill)
+            bill['period'] = period
+            bill['meter_reading'] = reading
+            bill['_id'] = ObjectId()
+            new_bills.append((user, bill))
+
+        if new_bills:
+            lost = set()
+            try:
+                bill_col.insert_many([bill for _, bill in new_bills], ordered=False)
+            except errors.BulkWriteError as e:
+                if any(err['code'] != 11000 for err in e.details.get('writeErrors', [])):
+                    raise
+                lost = {err['index'] for err in e.details['writeErrors']}
+            # lost inserts were billed by a concurrent run
+            billed += len(new_bills) - len(lost)
+            skipped += len(lost)
+            inserted = [(user, bill) for i, (user, bill) in enumerate(new_bills) if i not in lost]
+            accounts += [account_bill_op(user, bill) for user, bill in inserted]
+            replaced += [bill['replaces'] for _, bill in inserted if bill.get('replaces')]
+            marks += [billed_mark_op(user['id'], bill['meter_reading']) for user, bill in inserted]
+        if marks:
+            po_col.bulk_write(marks, ordered=False)
+        write_accounts(cols, accounts)
+        if replaced:
+            bill_col.update_many({'_id': {'$in': replaced}, 'status': 'unpaid'},
+                                 {'$set': {'status': 'replaced'}})
+
+def billing_runs_coll():
+    return get_client()[ADMIN_DB]['billing_runs'] if get_client() is not None else None
+
+def claim_billing_run(prefix, period):
+    """Mark prefix:period as running in billing_runs; False if a run is already in progress.
+
+    A run still marked running after BILLING_TIMEOUT is assumed dead and reclaimed.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=BILLING_TIMEOUT)
+    try:
+        billing_runs_coll().update_one(
+            {'_id': f'{prefix}:{period}', '$or': [{'status': {'$ne': 'running'}}, {'started_at': {'$lt': stale}}]},
+            {'$set': {'region': prefix, 'period': period, 'status': 'running', 'started_at': now},
+             '$unset': dict.fromkeys(['billed', 'skipped', 'failed_shards', 'seconds', 'bills_per_sec',
+                                      'finished_at', 'error'], '')},
+            upsert=True)
+    except errors.DuplicateKeyError:
+        return False
+    return True
+
+def run_billing(prefix, period, due_date, amounts_for):
+    """Bill a whole region for a period, all shards in parallel."""
+    start = time.perf_counter()
+    try:
+        results, failed = fan_out(prefix, lambda cols: bill_shard(cols, period, due_date, amounts_for),
+                                  timeout=BILLING_TIMEOUT, job=True)
+    except Exception as e:
+        billing_runs_coll().update_one({'_id': f'{prefix}:{period}'},
+                                       {'$set': {'status': 'failed', 'error': str(e),
+                                                 'finished_at': datetime.utcnow()}}, upsert=True)
+        raise
+    elapsed = time.perf_counter() - start
+    billed = sum(r['billed'] for r in results.values())
+    report = {
+        'region': prefix,
+        'period': period,
+        'billed': billed,
+        'skipped': sum(r['skipped'] for r in results.values()),
+        'failed_shards': failed,
+        'seconds': round(elapsed, 3),
+        'bills_per_sec': round(billed / elapsed, 1) if elapsed else 0,
+        'status': 'partial' if failed else 'done',
+        'finished_at': datetime.utcnow()
+    }
+    billing_runs_coll().update_one({'_id': f'{prefix}:{period}'}, {'$set': report}, upsert=True)
+    return report
+
+def _run_billing_bg(prefix, period, due_date, amounts_for):
+    try:
+        run_billing(prefix, period, due_date, amounts_for)
+    except Exception as e:
+        print("WARNING: billing run failed:", e)
+
+def recent_billing_runs(limit=5):
+    coll = billing_runs_coll()
+    return list(coll.find().sort('started_at', -1).limit(limit)) if coll is not None else []
+
+def flat_amount(amount):
+    return lambda cols, users, units: [amount] * len(users)
+
+@app.cli.command('bill-region')
+@click.argument('region')
+@click.argument('period')
+@click.option('--due-date', required=True, help='Due date stored on the new bills.')
+@click.option('--amount', type=float, help='Flat base amount for every customer (default: slab tariff).')
+def bill_region_command(region, period, due_date, amount):
+    """Bill every postpaid customer of REGION for PERIOD (e.g. 2026-10)."""
+    amounts_for = flat_amount(amount) if amount is not None else tariff_amounts('postpaid')
+    if not claim_billing_run(region_prefix(region), period):
+        raise click.ClickException(f"a billing run for {region} {period} is already in progress")
+    report = run_billing(region_prefix(region), period, due_date, amounts_for)
+    click.echo(f"billed {report['billed']}, skipped {report['skipped']} in {report['seconds']}s "
+               f"({report['bills_per_sec']} bills/s)")
+    if report['failed_shards']:
+        click.echo("failed shards: " + ", ".join(report['failed_shards']))
+
+# ---- Overdue fines ----
+# Due dates are stored as datetimes. Every night 'flask apply-fines' finds
+# unpaid bills whose due date has passed through the {status, due_date} index
+# and adds BILL_FINE to each one once (fined_at marks it), then updates the
+# Account summaries with the new amount. Pages only show the stored values.
+# 'flask migrate-due-dates' converts due dates stored as form strings.
+def apply_fines(cols, now=None):
+    """Fine one shard's overdue unpaid bills in batches; returns the count."""
+    bill_col = cols['Bill']
+    today = (now or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+    fined = 0
+    # fined bills leave the match, so each pass picks up the next batch
+    query = {'status': 'unpaid', 'due_date': {'$lt': today}, 'fined_at': {'$exists': False}}
+    while True:
+        bills = list(bill_col.find(query, {'id': 1, 'amount': 1, 'fine': 1}).sort('due_date', 1).limit(IN_QUERY_BATCH))
+        if not bills:
+            return fined
+        ops = [UpdateOne({'_id': b['_id'], 'status': 'unpaid', 'fined_at': {'$exists': False}},
+                         {'$inc': {'amount': BILL_FINE, 'fine': BILL_FINE}, '$set': {'fined_at': today}})
+               for b in bills]
+        fined += bill_col.bulk_write(ops, ordered=False).modified_count
+        write_accounts(cols, [
+            UpdateOne({'_id': b['id'], 'last_bill._id': b['_id'], 'last_bill.status': 'unpaid'},
+                      {'$set': {'last_bill.amount': b.get('amount', 0) + BILL_FINE,
+                                'last_bill.fine': b.get('fine', 0) + BILL_FINE,
+                                'outstanding': b.get('amount', 0) + BILL_FINE,
+                                'fine': b.get('fine', 0) + BILL_FINE,
+                                'updated_at': datetime.utcnow()}})
+            for b in bills
+        ])
+
+def migrate_due_dates(cols):
+    """Convert string due dates on one shard to datetimes; returns per-collection counts."""
+    db = cols['Bill'].database
+    report = {}
+    targets = [(cols['Bill'], 'due_date'), (cols['Postpaid'], 'due_date'), (cols['Account'], 'last_bill.due_date')]
+    targets += [(archive, 'due_date') for archive in archive_collections(db)]
+    for col, field in targets:
+        converted = 0
+        last_id = None
+        while True:
+            query = {field: {'$type': 'string'}}
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            docs = list(col.find(query, {field: 1}).sort('_id', 1).limit(IN_QUERY_BATCH))
+            if not docs:
+                break
+            last_id = docs[-1]['_id']
+            ops = []
+            for d in docs:
+                value = d.get('last_bill', {}).get('due_date') if field == 'last_bill.due_date' else d.get(field)
+                # unparseable strings (e.g. empty form fields) become null
+                ops.append(UpdateOne({'_id': d['_id']}, {'$set': {field: parse_due_date(value)}}))
+            converted += col.bulk_write(ops, ordered=False).modified_count
+        report[col.name] = converted
+    return report
+
+@app.cli.command('apply-fines')
+def apply_fines_command():
+    """Add the late fine to every overdue unpaid bill on every shard (run nightly)."""
+    for prefix in get_shard_map():
+        start = time.perf_counter()
+        results, failed = fan_out(prefix, apply_fines, timeout=BILLING_TIMEOUT, job=True)
+        click.echo(f"{prefix}: fined {sum(results.values())} bills in {time.perf_counter() - start:.1f}s")
+        for dbn in failed:
+            click.echo(f"{dbn}: FAILED")
+
+@app.cli.command('migrate-due-dates')
+def migrate_due_dates_command():
+    """Convert due dates stored as strings to datetimes on every shard."""
+    for prefix in get_shard_map():
+        results, failed = fan_out(prefix, migrate_due_dates, timeout=BILLING_TIMEOUT, job=True)
+        for dbn, report in results.items():
+            click.echo(f"{dbn}: " + ", ".join(f"{k} {v}" for k, v in report.items()))
+        for dbn in failed:
+            click.echo(f"{dbn}: FAILED")
+
+# ---- Prepaid deductions ----
+# Once per period every prepaid balance is drawn down by the slab tariff
+# charge on the consumption since the last deduction: the meter's unit_usage
+# minus the charged_units stored on the customer by the previous one, so a
+# period without a new reading charges nothing. Each shard is walked in
+# IN_QUERY_BATCH keyset batches with one bulk $inc per batch; all shards of
+# all regions run in parallel. A customer document keeps the last
+# DEDUCTION_PERIOD_WINDOW periods it was charged for, and each shard's last id
+# is checkpointed in managementdb.deduction_runs, so re-running a period
+# resumes it without charging anyone twice. Low balances are flagged.
+PREPAID_LOW_BALANCE = float(os.getenv("PREPAID_LOW_BALANCE", "100"))
+DEDUCTION_PERIOD_WINDOW = int(os.getenv("DEDUCTION_PERIOD_WINDOW", "24"))
+
+def deduction_runs_coll():
+    return get_client()[ADMIN_DB]['deduction_runs'] if get_client() is not None else None
+
+def flag_balances(pp_col, ids, threshold):
+    """Set balance_flag 'negative'/'low' (or clear it) for a batch; returns flagged counts."""
+    negative = pp_col.update_many({'id': {'$in': ids}, 'balance': {'$lt': 0}},
+                                  {'$set': {'balance_flag': 'negative'}}).matched_count
+    low = pp_col.update_many({'id': {'$in': ids}, 'balance': {'$gte': 0, '$lt': threshold}},
+                             {'$set': {'balance_flag': 'low'}}).matched_count
+    pp_col.update_many({'id': {'$in': ids}, 'balance': {'$gte': threshold}, 'balance_flag': {'$exists': True}},
+                       {'$unset': {'balance_flag': ''}})
+    return negative, low
+
+def deduct_shard(dbn, period, threshold=PREPAID_LOW_BALANCE):
+    """Charge every prepaid customer of one shard for period, from its checkpoint."""
+    runs = deduction_runs_coll()
+    run = runs.find_one({'_id': period}, {f'shards.{dbn}': 1}) or {}
+    report = run.get('shards', {}).get(dbn) or {'last_id': None, 'charged': 0, 'skipped': 0,
+                                                'amount': 0.0, 'negative': 0, 'low': 0, 'done': False}
+    if report['done']:
+        return report
+    cols = get_collections(get_client()[dbn])
+    pp_col = cols['Prepaid']
+    while True:
+        query = {'id': {'$gt': report['last_id']}} if report['last_id'] is not None else {}
+        users = list(pp_col.find(query, {'id': 1, 'meter_no': 1, 'location': 1, 'charged_units': 1})
+                     .sort('id', 1).limit(IN_QUERY_BATCH))
+        if not users:
+            break
+        readings, units = unbilled_usage(cols, users, 'charged_units')
+        # only consumption since the previous deduction
+        consumed = [(u, r, n) for u, r, n in zip(users, readings, units) if n > 0]
+        amounts = tariff_charges([u for u, _, _ in consumed], [n for _, _, n in consumed], 'prepaid')
+        ops = [UpdateOne({'id': user['id'], 'deducted_periods': {'$ne': period}},
+                         {'$inc': {'balance': -amount},
+                          '$set': {'charged_units': reading},
+                          '$push': {'deducted_periods': {'$each': [period], '$slice': -DEDUCTION_PERIOD_WINDOW}}})
+               for (user, reading, _), amount in zip(consumed, amounts)]
+        charged = pp_col.bulk_write(ops, ordered=False).modified_count if ops else 0
+        ids = [user['id'] for user in users]
+        negative, low = flag_balances(pp_col, ids, threshold)
+        report.update(last_id=ids[-1], charged=report['charged'] + charged,
+                      skipped=report['skipped'] + len(users) - charged,
+                      amount=round(report['amount'] + sum(amounts), 2),
+                      negative=report['negative'] + negative, low=report['low'] + low)
+        runs.update_one({'_id': period}, {'$set': {f'shards.{dbn}': report}}, upsert=True)
+    report['done'] = True
+    runs.update_one({'_id': period}, {'$set': {f'shards.{dbn}': report}}, upsert=True)
+    return report
+
+def run_deductions(period, threshold=PREPAID_LOW_BALANCE):
+    """Deduct period's charges on every shard of every region in parallel."""
+    start = time.perf_counter()
+    futures = {dbn: submit_shard(deduct_shard, dbn, period, threshold, job=True) for dbn in shard_db_names()}
+    wait_shards(futures.values(), BILLING_TIMEOUT)
+    shards, failed = {}, []
+    for dbn, fut in futures.items():
+        try:
+            shards[dbn] = fut.result(timeout=0)
+        except Exception:
+            failed.append(dbn)
+    elapsed = time.perf_counter() - start
+    charged = sum(r['charged'] for r in shards.values())
+    summary = {
+        'charged': charged,
+        'negative': sum(r['negative'] for r in shards.values()),
+        'low': sum(r['low'] for r in shards.values()),
+        'failed_shards': failed,
+        'seconds': round(elapsed, 3),
+        'customers_per_sec': round(charged / elapsed, 1) if elapsed else 0,
+    }
+    deduction_runs_coll().update_one({'_id': period}, {'$set': dict(summary, finished_at=datetime.utcnow())},
+                                     upsert=True)
+    return summary
+
+@app.cli.command('deduct-prepaid')
+@click.argument('period')
+@click.option('--threshold', type=float, default=PREPAID_LOW_BALANCE, show_default=True,
+              help='Flag balances below this amount as low.')
+def deduct_prepaid_command(period, threshold):
+    """Draw PERIOD's tariff charges from every prepaid balance; re-run to resume."""
+    report = run_deductions(period, threshold)
+    click.echo(f"charged {report['charged']} customers in {report['seconds']}s "
+               f"({report['customers_per_sec']}/s); {report['negative']} negative, {report['low']} low")
+    if report['failed_shards']:
+        click.echo("failed shards (re-run to resume): " + ", ".join(report['failed_shards']))
+
+# ---- Bill archive ----
+# Paid and replaced bills older than BILL_ARCHIVE_DAYS move out of the hot
+# Bill collection into one Bill_archive_YYYY_MM collection per month (by the
+# bill's ObjectId time) on the same shard. A customer's latest bill always
+# stays in Bill: carry_forward(), the Account summaries and batch billing read
+# it. Copies are upserts and the delete follows, so an interrupted run is
+# simply repeated. Only explicit history views read the archive.
+BILL_ARCHIVE_DAYS = int(os.getenv("BILL_ARCHIVE_DAYS", "365"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "5000"))
+ARCHIVE_PREFIX = 'Bill_archive_'
+ARCHIVED_STATUSES = ['paid', 'replaced']
+
+def archive_name(bill_id):
+    return ARCHIVE_PREFIX + bill_id.generation_time.strftime('%Y_%m')
+
+def archive_collections(db):
+    """This shard's archive collections, newest month first."""
+    names = db.list_collection_names(filter={'name': {'$regex': '^' + ARCHIVE_PREFIX}})
+    return [db[name] for name in sorted(names, reverse=True)]
+
+def archive_bills(cols, older_than_days=BILL_ARCHIVE_DAYS):
+    """Move one shard's old settled bills to the monthly archives; returns counts."""
+    bill_col = cols['Bill']
+    db = bill_col.database
+    cutoff = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=older_than_days))
+    archived = kept = 0
+    seen_archives = set()
+    last_id = None
+    while True:
+        query = {'status': {'$in': ARCHIVED_STATUSES},
+                 '_id': {'$lt': cutoff, '$gt': last_id} if last_id is not None else {'$lt': cutoff}}
+        batch = list(bill_col.find(query).sort('_id', 1).limit(ARCHIVE_BATCH))
+        if not batch:
+            return {'archived': archived, 'kept': kept}
+        last_id = batch[-1]['_id']
+        latest = {b['_id'] for b in latest_bills(bill_col, list({b['id'] for b in batch})).values()}
+
+        by_month = {}
+        for bill in batch:
+            if bill['_id'] in latest:
+                kept += 1
+                continue
+            by_month.setdefault(archive_name(bill['_id']), []).append(bill)
+        for name, bills in by_month.items():
+            if name not in seen_archives:
+                db[name].create_index([('id', ASCENDING), ('_id', DESCENDING)], name='id_latest')
+                seen_archives.add(name)
+            db[name].bulk_write([ReplaceOne({'_id': b['_id']}, b, upsert=True) for b in bills], ordered=False)
+        moved = [b['_id'] for bills in by_month.values() for b in bills]
+        if moved:
+            bill_col.delete_many({'_id': {'$in': moved}, 'status': {'$in': ARCHIVED_STATUSES}})
+        archived += len(moved)
+
+def bill_history(db, user_id, projection=None):
+    """Every archived bill of one customer, newest first."""
+    bills = []
+    for col in archive_collections(db):
+        bills.extend(col.find({'id': user_id}, projection).sort('_id', -1))
+    return bills
+
+@app.cli.command('archive-bills')
+@click.option('--older-than-days', type=int, default=BILL_ARCHIVE_DAYS, show_default=True,
+              help='Archive settled bills created more than this many days ago.')
+def archive_bills_command(older_than_days):
+    """Move old paid/replaced bills on every shard into monthly archive collections."""
+    for prefix in get_shard_map():
+        start = time.perf_counter()
+        results, failed = fan_out(prefix, lambda cols: archive_bills(cols, older_than_days),
+                                  timeout=BILLING_TIMEOUT, job=True)
+        elapsed = time.perf_counter() - start
+        for dbn, report in results.items():
+            click.echo(f"{dbn}: archived {report['archived']}, kept {report['kept']} latest")
+        for dbn in failed:
+            click.echo(f"{dbn}: FAILED")
+        archived = sum(r['archived'] for r in results.values())
+        click.echo(f"{prefix}: {archived} bills in {elapsed:.1f}s "
+                   f"({archived / elapsed if elapsed else 0:.0f} bills/s)")
+
+# ---- Bulk user import ----
+# Streams a CSV or NDJSON file with the create_user form fields (id, name,
+# user_type, customer_type, password, balance, recharge_date, due_date,
+# unit_usage) and writes IMPORT_BATCH rows at a time: passwords hashed in
+# parallel, meter numbers reserved as one block, one unordered bulk_write per
+# shard collection. Bad rows are reported by line number, never abort a run.
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "1000"))
+
+def read_import_rows(stream, fmt):
+    """Yield (line number, row dict or error string) from a text stream.
+
+    A malformed CSV row is reported and skipped; bytes that do not decode
+    end the file with one error (decoding runs ahead in chunks, so it names
+    the last row read).
+    """
+    line_no = 0
+    try:
+        if fmt == 'csv':
+            reader = csv.DictReader(stream)
+            while True:
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    return
+                except csv.Error as e:
+                    # DictReader.line_num is only updated after a good row
+                    line_no = reader.reader.line_num
+                    yield line_no, f"invalid CSV: {e}"
+                    continue
+                line_no = reader.line_num
+                yield line_no, row
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, f"invalid JSON: {e}"
+                continue
+            yield line_no, row if isinstance(row, dict) else "row must be a JSON object"
+    except UnicodeDecodeError:
+        yield line_no, "file is not valid UTF-8; nothing after this row was read"
+
+def validate_import_row(row):
+    """Normalised row, or raise ValueError with the reason."""
+    try:
+        user_id = int(str(row.get('id', '')).strip())
+    except (TypeError, ValueError):
+        raise ValueError("invalid id")
+    if user_id <= 0:
+        raise ValueError("id must be positive")
+    if not row.get('password'):
+        raise ValueError("password is required")
+    role = str(row.get('user_type') or 'customer').strip().lower()
+    if role not in ('agent', 'customer'):
+        raise ValueError("user_type must be agent or customer")
+    clean = {'id': user_id, 'name': row.get('name'), 'user_type': role, 'password': str(row['password'])}
+    if role == 'customer':
+        customer_type = str(row.get('customer_type') or 'prepaid').strip().lower()
+        if customer_type not in ('prepaid', 'postpaid'):
+            raise ValueError("customer_type must be prepaid or postpaid")
+        clean['customer_type'] = customer_type
+        try:
+            clean['unit_usage'] = float(row.get('unit_usage') or 0)
+            clean['balance'] = float(row.get('balance') or 0)
+        except (TypeError, ValueError):
+            raise ValueError("unit_usage and balance must be numbers")
+        if not (math.isfinite(clean['unit_usage']) and math.isfinite(clean['balance'])):
+            raise ValueError("unit_usage and balance must be finite numbers")
+        clean['recharge_date'] = row.get('recharge_date')
+        clean['due_date'] = parse_due_date(row.get('due_date'))
+    return clean
+
+def _import_batch(location, batch, errors_out):
+    """Write one batch of validated (line, row) pairs; returns rows written."""
+    hashes = hash_passwords([row['password'] for _, row in batch])
+    customers = sum(1 for _, row in batch if row['user_type'] == 'customer')
+    meters = iter(reserve_meter_block(meter_prefix(location), customers)) if customers else iter(())
+
+    ops = {}          # (db name, collection) -> [(line, op)]
+    identities = []
+    for (line, row), pwhash in zip(batch, hashes):
+        dbn = choose_db(location, row['id'])
+        doc = {'id': row['id'], 'name': row['name'], 'location': location,
+               'password': pwhash, 'user_type': row['user_type']}
+        if row['user_type'] == 'agent':
+            col_name = 'Agent'
+        else:
+            doc['customer_type'] = row['customer_type']
+            doc['meter_no'] = next(meters)
+            meter_doc = {'meter_no': doc['meter_no'], 'location': location, 'unit_usage': row['unit_usage']}
+            ops.setdefault((dbn, 'Meter_inf'), []).append(
+                (line, UpdateOne({'meter_no': doc['meter_no']}, {'$set': meter_doc}, upsert=True)))
+            if row['customer_type'] == 'prepaid':
+                col_name = 'Prepaid'
+                doc['balance'] = row['balance']
+                doc['recharge_date'] = row['recharge_date']
+            else:
+                col_name = 'Postpaid'
+                doc['due_date'] = row['due_date']
+                ops.setdefault((dbn, 'Account'), []).append((line, account_profile_op(doc)))
+        ops.setdefault((dbn, col_name), []).append(
+            (line, UpdateOne({'id': row['id']}, {'$set': doc}, upsert=True)))
+        role = SHARD_ROLES[col_name]
+        identities.append((line, UpdateOne({'_id': _identity_key(role, row['id'], dbn)},
+                                           {'$set': {'id': row['id'], 'role': role, 'db': dbn,
+                                                     'password': pwhash, 'location': location}}, upsert=True)))
+
+    failed_lines = set()
+    for (dbn, col_name), line_ops in ops.items():
+        try:
+            get_client()[dbn][col_name].bulk_write([op for _, op in line_ops], ordered=False)
+        except errors.BulkWriteError as e:
+            for err in e.details.get('writeErrors', []):
+                line = line_ops[err['index']][0]
+                failed_lines.add(line)
+                errors_out.append((line, f"{dbn}.{col_name}: {err.get('errmsg')}"))
+    # rows whose shard write failed get no directory entry
+    identity_ops = [op for line, op in identities if line not in failed_lines]
+    if identity_ops:
+        identity_coll().bulk_write(identity_ops, ordered=False)
+    invalidate_identity(*[row['id'] for line, row in batch if line not in failed_lines])
+    return len(batch) - len(failed_lines)
+
+def import_users(location, stream, fmt='csv'):
+    """Import every row of stream into location's shards; returns a report."""
+    start = time.perf_counter()
+    errors_out = []
+    imported = 0
+    seen = set()
+    batch = []
+    for line, row in read_import_rows(stream, fmt):
+        if isinstance(row, str):
+            errors_out.append((line, row))
+            continue
+        try:
+            row = validate_import_row(row)
+        except ValueError as e:
+            errors_out.append((line, str(e)))
+            continue
+        if row['id'] in seen:
+            errors_out.append((line, f"duplicate id {row['id']} in file"))
+            continue
+        seen.add(row['id'])
+        batch.append((line, row))
+        if len(batch) >= IMPORT_BATCH:
+            imported += _import_batch(location, batch, errors_out)
+            batch = []
+    if batch:
+        imported += _import_batch(location, batch, errors_out)
+    elapsed = time.perf_counter() - start
+    return {
+        'imported': imported,
+        'errors': sorted(errors_out),
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(imported / elapsed, 1) if elapsed else 0
+    }
+
+@app.cli.command('import-users')
+@click.argument('location')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--errors', 'errors_path', type=click.Path(), help='Write the per-row error report as CSV.')
+def import_users_command(location, path, errors_path):
+    """Bulk import agents/customers for LOCATION from a .csv or .ndjson file."""
+    fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+    with open(path, newline='') as f:
+        report = import_users(location, f, fmt)
+    click.echo(f"imported {report['imported']} rows in {report['seconds']}s "
+               f"({report['rows_per_sec']} rows/s), {len(report['errors'])} errors")
+    if errors_path:
+        with open(errors_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['line', 'error'])
+            writer.writerows(report['errors'])
+    else:
+        for line, message in report['errors']:
+            click.echo(f"line {line}: {message}")
+
+# ---- Meter reading ingestion ----
+# Streams readings (meter_no, unit_usage, read_at, optional id/location) from
+# CSV/NDJSON files, a spool directory or an in-process queue. Readings are
+# validated, de-duplicated per batch, routed to the shard holding the meter
+# and applied as guarded bulk upserts: a reading only lands if it is newer
+# than the stored read_at, so re-delivered or out-of-order readings are
+# no-ops. At most INGEST_MAX_PENDING batches are in flight; the reader blocks
+# beyond that, which bounds memory to about (pending + 1) * batch size.
+INGEST_BATCH = int(os.getenv("INGEST_BATCH", "5000"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "4"))
+METER_NO_RE = re.compile(r'^[A-Z]{2}_\d{6,}$')
+METER_REGIONS = {'DH': 'Desco', 'RH': 'Nesco', 'AL': 'PBS'}
+
+def validate_reading(row):
+    """Normalised reading, or raise ValueError with the reason."""
+    meter_no = str(row.get('meter_no') or '').strip().upper()
+    if not METER_NO_RE.match(meter_no):
+        raise ValueError("invalid meter_no")
+    try:
+        units = float(row.get('unit_usage'))
+    except (TypeError, ValueError):
+        raise ValueError("unit_usage must be a number")
+    if units < 0:
+        raise ValueError("unit_usage must not be negative")
+    try:
+        read_at = datetime.fromisoformat(str(row.get('read_at') or '').strip())
+    except ValueError:
+        raise ValueError("read_at must be an ISO date/time")
+    if read_at.tzinfo is not None:
+        # stored and compared as naive UTC, like every other datetime here
+        read_at = read_at.astimezone(timezone.utc).replace(tzinfo=None)
+    reading = {'meter_no': meter_no, 'unit_usage': units, 'read_at': read_at}
+    if row.get('id') not in (None, ''):
+        try:
+            reading['id'] = int(row['id'])
+        except ValueError:
+            raise ValueError("invalid id")
+    if row.get('location'):
+        reading['location'] = str(row['location']).strip().lower()
+    return reading
+
+def queue_rows(q, sentinel=None):
+    """(position, row) pairs from a queue.Queue until sentinel is put."""
+    position = 0
+    while True:
+        row = q.get()
+        if row is sentinel:
+            return
+        position += 1
+        yield position, row
+
+def reading_region(reading):
+    if reading.get('location'):
+        return region_prefix(reading['location'])
+    return METER_REGIONS.get(reading['meter_no'].split('_', 1)[0], 'PBS')
+
+def locate_meters(prefix, meter_nos):
+    """meter_no -> shard for meters already stored in a region, one $in per shard."""
+    results, _ = fan_out(prefix, lambda cols: [m['meter_no'] for m in cols['Meter_inf'].find(
+        {'meter_no': {'$in': meter_nos}}, {'_id': 0, 'meter_no': 1})])
+    return {meter_no: dbn for dbn, found in results.items() for meter_no in found}
+
+def _reading_op(reading):
+    """Upsert that only takes the reading if it is newer than the stored one.
+
+    The guard is inside an update pipeline rather than the filter, so a stale
+    reading matches its meter and changes nothing instead of colliding with
+    the unique meter_no index as a second upsert.
+    """
+    doc = {'unit_usage': reading['unit_usage'], 'read_at': reading['read_at']}
+    if reading.get('location'):
+        doc['location'] = reading['location']
+    # a meter without a reading yet (or a new upsert) takes any reading
+    newer = {'$lt': [{'$ifNull': ['$read_at', None]}, reading['read_at']]}
+    return UpdateOne({'meter_no': reading['meter_no']},
+                     [{'$set': {k: {'$cond': [newer, {'$literal': v}, f'${k}']} for k, v in doc.items()}}],
+                     upsert=True)
+
+def _apply_readings(batch, ordered):
+    """Route and write one batch of (position, reading); returns its counts and errors."""
+    counts = {'applied': 0, 'stale': 0, 'not_applied': 0}
+    errors_out = []
+    by_region = {}
+    for pos, reading in batch:
+        by_region.setdefault(reading_region(reading), []).append((pos, reading))
+    ops = {}
+    for prefix, readings in by_region.items():
+        unrouted = [r['meter_no'] for _, r in readings if 'id' not in r]
+        located = locate_meters(prefix, unrouted) if unrouted else {}
+        for pos, reading in readings:
+            dbn = route_shard(prefix, reading['id']) if 'id' in reading else located.get(reading['meter_no'])
+            if dbn is None:
+                errors_out.append((pos, f"unknown meter {reading['meter_no']} (give id to create it)"))
+                continue
+            ops.setdefault(dbn, []).append(_reading_op(reading))
+    for dbn, shard_ops in ops.items():
+        try:
+            result = get_client()[dbn]['Meter_inf'].bulk_write(shard_ops, ordered=ordered)
+            counts['applied'] += result.modified_count + result.upserted_count
+            counts['stale'] += result.matched_count - result.modified_count
+        except errors.BulkWriteError as e:
+            details = e.details
+            write_errors = details.get('writeErrors', [])
+            counts['applied'] += details.get('nModified', 0) + details.get('nUpserted', 0)
+            counts['stale'] += details.get('nMatched', 0) - details.get('nModified', 0)
+            for err in write_errors:
+                errors_out.append((None, f"{dbn}: {err.get('errmsg')}"))
+            if ordered and write_errors:
+                # an ordered batch stops at its first error
+                skipped = len(shard_ops) - write_errors[0]['index'] - 1
+                if skipped:
+                    counts['not_applied'] += skipped
+                    errors_out.append((None, f"{dbn}: {skipped} readings not applied after the first error"))
+    return counts, errors_out
+
+def ingest_readings(rows, ordered=False, batch_size=INGEST_BATCH, max_pending=INGEST_MAX_PENDING):
+    """Ingest an iterable of (position, row) pairs; returns a throughput report."""
+    start = time.perf_counter()
+    report = {'read': 0, 'invalid': 0, 'duplicates': 0, 'applied': 0, 'stale': 0, 'not_applied': 0, 'errors': []}
+    slots = threading.BoundedSemaphore(max_pending)
+    lock = threading.Lock()
+
+    def done(fut):
+        slots.release()
+        try:
+            counts, errs = fut.result()
+        except Exception as e:
+            counts, errs = {}, [(None, str(e))]
+        with lock:
+            for k, v in counts.items():
+                report[k] += v
+            report['errors'].extend(errs)
+
+    def flush(latest):
+        slots.acquire()   # backpressure: wait for a free slot
+        fut = writers.submit(contextvars.copy_context().run, _apply_readings,
+                             sorted(latest.values(), key=lambda p: p[0]), ordered)
+        fut.add_done_callback(done)
+
+    with ThreadPoolExecutor(max_workers=max_pending, thread_name_prefix="ingest") as writers:
+        latest = {}
+        for pos, row in rows:
+            report['read'] += 1
+            try:
+                if not isinstance(row, dict):
+                    raise ValueError(row if isinstance(row, str) else "row must be an object")
+                reading = validate_reading(row)
+            except ValueError as e:
+                report['invalid'] += 1
+                with lock:
+                    report['errors'].append((pos, str(e)))
+                continue
+            seen = latest.get(reading['meter_no'])
+            if seen is not None:
+                report['duplicates'] += 1
+                if seen[1]['read_at'] >= reading['read_at']:
+                    continue
+            latest[reading['meter_no']] = (pos, reading)
+            if len(latest) >= batch_size:
+                flush(latest)
+                latest = {}
+        if latest:
+            flush(latest)
+    elapsed = time.perf_counter() - start
+    report.update(seconds=round(elapsed, 3),
+                  readings_per_sec=round(report['read'] / elapsed, 1) if elapsed else 0)
+    report['errors'].sort(key=lambda e: (e[0] is None, e[0] or 0))
+    return report
+
+def ingest_runs_coll():
+    return get_client()[ADMIN_DB]['ingest_runs'] if get_client() is not None else None
+
+@app.cli.command('ingest-readings')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--ordered', is_flag=True, help='Stop each shard batch at its first write error.')
+@click.option('--batch-size', type=int, default=INGEST_BATCH, show_default=True)
+@click.option('--max-pending', type=int, default=INGEST_MAX_PENDING, show_default=True,
+              help='Batches in flight before reading pauses (backpressure).')
+@click.option('--errors', 'errors_path', type=click.Path(), help='Write the per-row error report as CSV.')
+def ingest_readings_command(path, ordered, batch_size, max_pending, errors_path):
+    """Load meter readings from a .csv/.ndjson file, or every file of a spool directory.
+
+    Spooled files are moved to PATH/done once ingested, so a scheduled run
+    only picks up new ones.
+    """
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                       if name.endswith(('.csv', '.ndjson', '.jsonl')))
+    all_errors = []
+    for file_path in files:
+        fmt = 'ndjson' if file_path.endswith(('.ndjson', '.jsonl')) else 'csv'
+        with open(file_path, newline='') as f:
+            report = ingest_readings(read_import_rows(f, fmt), ordered, batch_size, max_pending)
+        all_errors += [(file_path, line, message) for line, message in report['errors']]
+        click.echo(f"{file_path}: read {report['read']}, applied {report['applied']}, "
+                   f"stale {report['stale']}, not applied {report['not_applied']}, duplicates {report['duplicates']}, "
+                   f"invalid {report['invalid']} in {report['seconds']}s ({report['readings_per_sec']} readings/s)")
+        ingest_runs_coll().insert_one(dict({k: v for k, v in report.items() if k != 'errors'},
+                                           source=file_path, error_count=len(report['errors']),
+                                           finished_at=datetime.utcnow()))
+        if os.path.isdir(path):
+            os.makedirs(os.path.join(path, 'done'), exist_ok=True)
+            os.replace(file_path, os.path.join(path, 'done', os.path.basename(file_path)))
+    if errors_path:
+        with open(errors_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file', 'line', 'error'])
+            writer.writerows(all_errors)
+    else:
+        for file_path, line, message in all_errors:
+            click.echo(f"{file_path} line {line}: {message}")
+
+# ---- Payments ----
+# Single payments are one find_one_and_update each. Batched payments carry
+# an idempotency key, namespaced per agent: the key is first recorded in the
+# shard's Payment ledger (unique index), then applied. The balance $inc is guarded by the
+# last PAYMENT_KEY_WINDOW keys kept on the customer document and a paid
+# bill records its key, so re-sending a batch never applies a payment twice.
+PAYMENT_BATCH_MAX = int(os.getenv("PAYMENT_BATCH_MAX", "1000"))
+PAYMENT_BATCH_TIMEOUT = float(os.getenv("PAYMENT_BATCH_TIMEOUT", "30"))
+PAYMENT_KEY_WINDOW = int(os.getenv("PAYMENT_KEY_WINDOW", "50"))
+
+def apply_payment(cols, user_id, amount):
+    """Recharge a prepaid account or settle the unpaid bill, atomically.
+
+    Returns 'recharged', 'bill_paid' or None when there is nothing to pay.
+    """
+    pp_col = cols.get('Prepaid')
+    bill_col = cols.get('Bill')
+    if pp_col is not None and pp_col.find_one_and_update({'id': user_id}, {'$inc': {'balance': amount}},
+                                                         projection={'_id': 1}):
+        return 'recharged'
+    bill = bill_col.find_one_and_update({'id': user_id, 'status': 'unpaid'}, {'$set': {'status': 'paid'}},
+                                        projection={'_id': 1}) if bill_col is not None else None
+    if bill:
+        write_accounts(cols, [account_paid_op(user_id, bill['_id'])])
+        return 'bill_paid'
+    return None
+
+def apply_payment_batch(cols, payments, agent_id):
+    """Apply one shard's payments with bulk writes; returns {key: status}.
+
+    Keys are stored as "<agent_id>:<key>", so two agents sending the same
+    key never collide; results are reported under the agent's own keys.
+    """
+    ledger, pp_col, bill_col = cols['Payment'], cols['Prepaid'], cols['Bill']
+    now = datetime.utcnow()
+    agent_keys = {f"{agent_id}:{p['key']}": p['key'] for p in payments}
+    payments = [dict(p, key=f"{agent_id}:{p['key']}") for p in payments]
+    entries = [{'key': p['key'], 'id': p['user_id'], 'amount': p['amount'], 'agent': agent_id,
+                'status': 'pending', 'received_at': now} for p in payments]
+    try:
+        ledger.insert_many(entries, ordered=False)
+    except errors.BulkWriteError as e:
+        if any(err['code'] != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+    keys = [p['key'] for p in payments]
+    # keys seen before: only finish the ones a previous request left pending
+    known = {d['key']: d for d in ledger.find({'key': {'$in': keys}}, {'key': 1, 'status': 1, 'agent': 1})}
+    results = {}
+    todo = []
+    for p in payments:
+        entry = known.get(p['key'])
+        if entry and entry['status'] != 'pending':
+            results[p['key']] = 'duplicate'
+        else:
+            todo.append(p)
+    if not todo:
+        return {agent_keys[k]: v for k, v in results.items()}
+
+    prepaid_ids = {d['id'] for d in pp_col.find({'id': {'$in': [p['user_id'] for p in todo]}}, {'id': 1})}
+    recharges = [UpdateOne({'id': p['user_id'], 'payment_keys': {'$ne': p['key']}},
+                           {'$inc': {'balance': p['amount']},
+                            '$push': {'payment_keys': {'$each': [p['key']], '$slice': -PAYMENT_KEY_WINDOW}}})
+                 for p in todo if p['user_id'] in prepaid_ids]
+    if recharges:
+        pp_col.bulk_write(recharges, ordered=False)
+
+    postpaid = [p for p in todo if p['user_id'] not in prepaid_ids]
+    postpaid_keys = [p['key'] for p in postpaid]
+    settled = {d['payment_key'] for d in bill_col.find({'payment_key': {'$in': postpaid_keys}}, {'payment_key': 1})}
+    settles = [UpdateOne({'id': p['user_id'], 'status': 'unpaid'},
+                         {'$set': {'status': 'paid', 'payment_key': p['key']}})
+               for p in postpaid if p['key'] not in settled]
+    if settles:
+        # ordered: a second payment for the same customer finds no unpaid bill
+        bill_col.bulk_write(settles, ordered=True)
+        paid = list(bill_col.find({'payment_key': {'$in': postpaid_keys}}, {'payment_key': 1, 'id': 1}))
+        settled = {d['payment_key'] for d in paid}
+        write_accounts(cols, [account_paid_op(d['id'], d['_id']) for d in paid])
+
+    for p in todo:
+        if p['user_id'] in prepaid_ids:
+            results[p['key']] = 'recharged'
+        else:
+            results[p['key']] = 'bill_paid' if p['key'] in settled else 'no_target'
+    for status in ('recharged', 'bill_paid', 'no_target'):
+        done = [k for k, v in results.items() if v == status]
+        if done:
+            ledger.update_many({'key': {'$in': done}}, {'$set': {'status': status}})
+    return {agent_keys[k]: v for k, v in results.items()}
+
 # Helpers
 def login_required(f):
     @wraps(f)
@@ -99,10 +2650,50 @@ def role_required(roles):
 def inject_user():
     return dict(user=session.get('user'))
 
+@app.context_processor
+def inject_paging():
+    return dict(page_url=page_url)
+
+@app.template_filter('datefmt')
+def datefmt(value, empty='-'):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    return value or empty
+
 @app.route('/')
 def index():
     return redirect(url_for('login'))
 
+# ---- Health ----
+@app.route('/metrics')
+def metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the worker is up; does not touch Mongo."""
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: this worker's client can reach Mongo within READY_TIMEOUT."""
+    c = get_client()
+    if c is None:
+        return jsonify({'status': 'unavailable', 'error': 'no MongoDB client'}), 503
+    try:
+        with mongo_timeout(READY_TIMEOUT):
+            c[ADMIN_DB].command('ping')
+    except Exception as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    return jsonify({'status': 'ready', 'pid': os.getpid()})
+
+@app.errorhandler(errors.ConnectionFailure)
+def mongo_unavailable(e):
+    # the client connects lazily, so an outage surfaces here instead of at import
+    if request.path.startswith('/api/'):
+        return jsonify({'error': 'Database connection error'}), 503
+    return "Database connection error", 503
+
 ##login system
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -119,64 +2710,37 @@ def login():
             return redirect(url_for('login'))
 
         # ----------------------------------------------------
-        # 1️⃣ TRY LOGIN FROM CENTRAL DB (ADMIN + COMPANY)
+        # 1️⃣ ONE DIRECTORY LOOKUP (ADMIN, COMPANY, DISTRIBUTED USERS)
         # ----------------------------------------------------
-        admin_col_obj = admin_coll()
-        admin_user = None
-        if admin_col_obj is not None:
-            admin_user = admin_col_obj.find_one({'id': user_id})
-
-        if admin_user and check_password_hash(admin_user.get('password', ''), password):
-            session['user'] = {
-                'id': admin_user['id'],
-                'user_type': 'admin',
-                'location': 'admin'
-            }
-            flash("Logged in as Admin", "success")
-            return redirect(url_for('dashboard'))
-
-        company_col_obj = company_coll()
-        company_user = None
-        if company_col_obj is not None:
-            company_user = company_col_obj.find_one({'id': user_id})
-
-        if company_user and check_password_hash(company_user.get('password', ''), password):
-            session['user'] = {
-                'id': company_user['id'],
-                'user_type': 'company',
-                'location': company_user.get('location', 'other')
-            }
-            flash("Logged in as Company", "success")
-            return redirect(url_for('dashboard'))
-
-        # ----------------------------------------------------
-        # 2️⃣ TRY LOGIN FROM DISTRIBUTED COMPANY DATABASES
-        # ----------------------------------------------------
-        # use location + id to choose DB:
-        db = get_db_for_location(location, user_id)
-        cols = get_collections(db)
-
-        lookup_order = [
-            ('Agent', 'agent'),
-            ('Prepaid', 'customer_prepaid'),
-            ('Postpaid', 'customer_postpaid')
-        ]
-
-        for col_name, user_type in lookup_order:
-            col = cols.get(col_name)
-            if col is None:
+        for entry in login_candidates(user_id, location):
+            if not verify_password(entry.get('password', ''), password):
                 continue
-
-            user = col.find_one({'id': user_id})
-            if user and check_password_hash(user.get('password', ''), password):
+            if needs_rehash(entry.get('password')):
+                rehash_identity(entry, password)
+            role = entry['role']
+            if role == 'admin':
                 session['user'] = {
                     'id': user_id,
-                    'user_type': user_type,
-                    'location': location,
-                    'db': db.name if db is not None else None
+                    'user_type': 'admin',
+                    'location': 'admin'
                 }
-                flash(f"Logged in as {user_type}", "success")
-                return redirect(url_for('dashboard'))
+                flash("Logged in as Admin", "success")
+            elif role == 'company':
+                session['user'] = {
+                    'id': user_id,
+                    'user_type': 'company',
+                    'location': entry.get('location') or 'other'
+                }
+                flash("Logged in as Company", "success")
+            else:
+                session['user'] = {
+                    'id': user_id,
+                    'user_type': role,
+                    'location': entry.get('location') or location,
+                    'db': entry.get('db')
+                }
+                flash(f"Logged in as {role}", "success")
+            return redirect(url_for('dashboard'))
 
         # ----------------------------------------------------
         # 3️⃣ NO MATCH FOUND
@@ -194,163 +2758,212 @@ def logout():
     flash("Logged out", "success")
     return redirect(url_for('login'))
 
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    u = session['user']
-    role = u['user_type']
-    if role == 'admin':
-        admin_coll_obj = admin_coll()
-        company_coll_obj = company_coll()
-        admins = list(admin_coll_obj.find({})) if admin_coll_obj is not None else []
-        companies = list(company_coll_obj.find({})) if company_coll_obj is not None else []
-        summary = []
-        for dbn in DB_NAMES:
-            try:
-                db = client[dbn] if client is not None else None
-                cols = get_collections(db)
-                users_count = 0
-                for k in ('Agent','Prepaid','Postpaid'):
-                    col = cols.get(k)
-                    if col is not None:
-                        try:
-                            users_count += col.count_documents({})
-                        except Exception:
-                            users_count += 0
-                bills_count = 0
-                bill_col = cols.get('Bill')
-                if bill_col is not None:
-                    try:
-                        bills_count = bill_col.count_documents({})
-                    except Exception:
-                        bills_count = 0
-            except Exception:
-                users_count = 0
-                bills_count = 0
-            summary.append({'db': dbn, 'users': users_count, 'bills': bills_count})
-        return render_template('dashboard_admin.html', admin_users=admins+companies, summary=summary)
+# ---- Dashboard data ----
+# Shared by the HTML dashboards and the JSON API; every query projects only
+# the fields the views show (never password hashes).
+COMPANY_LIST_FIELDS = {'id': 1, 'name': 1, 'role': 1, 'balance': 1, 'bill_amount': 1,
+                       'status': 1, 'due_date': 1, 'meter_no': 1, 'balance_flag': 1}
+PROFILE_FIELDS = {'password': 0, 'payment_keys': 0, 'deducted_periods': 0, 'charged_units': 0,
+                  'billed_units': 0}
+CUSTOMER_BILL_LIMIT = int(os.getenv("CUSTOMER_BILL_LIMIT", "24"))
+
+def admin_dashboard_data():
+    admin_coll_obj = admin_coll()
+    company_coll_obj = company_coll()
+    fields = {'_id': 0, 'id': 1, 'user_type': 1, 'location': 1}
+    admins = list(admin_coll_obj.find({}, fields)) if admin_coll_obj is not None else []
+    companies = list(company_coll_obj.find({}, fields)) if company_coll_obj is not None else []
+    summary, refreshed_at = get_shard_stats()
+    return {
+        'admin_users': admins + companies,
+        'summary': summary,
+        'stats_time': datetime.fromtimestamp(refreshed_at).strftime('%Y-%m-%d %H:%M:%S'),
+        'billing_runs': recent_billing_runs()
+    }
 
-    if role == 'company':
-        company_coll_obj = company_coll()
+def company_dashboard_data(u, args):
+    company_coll_obj = company_coll()
 
-        # get company document safely
-        comp = company_coll_obj.find_one({'id': u['id']}) if company_coll_obj is not None else None
+    # get company document safely
+    comp = company_coll_obj.find_one({'id': u['id']}, {'password': 0}) if company_coll_obj is not None else None
 
-        location = comp.get('location', 'other').lower() if comp else 'other'
+    location = comp.get('location', 'other').lower() if comp else 'other'
+    prefix = region_prefix(location)
 
-        # Determine DB prefix
-        if location in ('rajshahi', 'nesco'):
-            prefix = 'Nesco'
-        elif location in ('dhaka', 'desco'):
-            prefix = 'Desco'
-        else:
-            prefix = 'PBS'
+    # Only the visible page of each section is read, filtered server-side
+    q = args.get('q', '')
+    filt = search_filter(q)
+    sections = (('agents', 'Agent'), ('prepaid', 'Prepaid'), ('postpaid', 'Postpaid'))
+    cursors = {key: args.get(f'{key}_after', type=int) for key, _ in sections}
 
-        # Load all DBs for this company
-        db_list = []
-        if client is not None:
-            for suf in ('1','2','3'):
-                try:
-                    db_list.append(client[f"{prefix}{suf}"])
-                except Exception:
-                    # skip missing DBs
-                    continue
+    # Query all shards of this company's region at once
+    def load_shard(cols):
+        return {
+            key: page_query(cols.get(col_name), filt, cursors[key], projection=COMPANY_LIST_FIELDS)
+            for key, col_name in sections
+        }
 
-        agents = []
-        prepaid = []
-        postpaid = []
-        bills = []
+    async def aload_shard(cols):
+        pages = await asyncio.gather(*(
+            apage_query(cols.get(col_name), filt, cursors[key], projection=COMPANY_LIST_FIELDS)
+            for key, col_name in sections
+        ))
+        return {key: page for (key, _), page in zip(sections, pages)}
+
+    results, failed = fan_out(prefix, load_shard, aquery=aload_shard)
+
+    pages = {}
+    for key, _ in sections:
+        rows, next_cursor, total = merge_pages([shard[key] for shard in results.values()])
+        # a shard that hit PAGE_COUNT_LIMIT has more matches than counted
+        capped = bool(filt) and any(shard[key][1] >= PAGE_COUNT_LIMIT for shard in results.values())
+        pages[key] = {'rows': rows, 'next': next_cursor, 'count': total, 'count_capped': capped}
+    return {'company': comp, 'pages': pages, 'q': q, 'failed_shards': failed}
+
+def agent_bills_data(u, args):
+    # Derive location prefix same as company
+    prefix = region_prefix(u.get('location', 'other'))
+
+    # One page of matching bills from all DB shards, newest first
+    bills, next_cursor, _, failed = paginate_shards(
+        prefix, 'Bill', bill_search_filter(args),
+        after=object_id_or_none(args.get('after')),
+        projection=BILL_LIST_FIELDS, count=False, sort_key='_id', descending=True
+    )
+    return {'bills': bills, 'next_cursor': next_cursor, 'failed_shards': failed}
 
-        for db in db_list:
-            cols = get_collections(db)
+def customer_dashboard_data(u, history=False):
+    db = get_db_for_location(u.get('location', 'other'), u['id']) if get_client() is not None else None
+    cols = get_collections(db)
+    profile = None
+    pp_col = cols.get('Prepaid')
+    if pp_col is not None:
+        profile = pp_col.find_one({'id': u['id']}, PROFILE_FIELDS)
 
-            agent_col = cols.get('Agent')
-            if agent_col is not None:
-                try:
-                    agents.extend(list(agent_col.find({})))
-                except Exception:
-                    pass
+    if profile is None:
+        po_col = cols.get('Postpaid')
+        if po_col is not None:
+            profile = po_col.find_one({'id': u['id']}, PROFILE_FIELDS)
 
-            pp_col = cols.get('Prepaid')
-            if pp_col is not None:
-                try:
-                    prepaid.extend(list(pp_col.find({})))
-                except Exception:
-                    pass
+    # postpaid: amount due and fine come from the account summary
+    account_col = cols.get('Account')
+    account = account_col.find_one({'_id': u['id']}, {'outstanding': 1, 'fine': 1, 'last_bill': 1}) \
+        if account_col is not None and profile is not None and profile.get('customer_type') == 'postpaid' else None
 
-            po_col = cols.get('Postpaid')
-            if po_col is not None:
-                try:
-                    postpaid.extend(list(po_col.find({})))
-                except Exception:
-                    pass
+    bill_col = cols.get('Bill')
+    bills = list(bill_col.find({'id': u['id']}, BILL_LIST_FIELDS).sort('_id', -1)
+                 .limit(0 if history else CUSTOMER_BILL_LIMIT)) if bill_col is not None else []
+    if history and db is not None:
+        # older settled bills live in the monthly archives
+        bills.extend(bill_history(db, u['id'], BILL_LIST_FIELDS))
+    return {'profile': profile, 'account': account, 'bills': bills, 'history': history}
 
-            bill_col = cols.get('Bill')
-            if bill_col is not None:
-                try:
-                    bills.extend(list(bill_col.find({})))
-                except Exception:
-                    pass
+@app.route('/dashboard')
+@login_required
+def dashboard():
+    u = session['user']
+    role = u['user_type']
+    if role == 'admin':
+        return render_template('dashboard_admin.html', **admin_dashboard_data())
 
+    if role == 'company':
+        data = company_dashboard_data(u, request.args)
+        flash_partial(data['failed_shards'])
+        pages = data['pages']
         return render_template(
             'dashboard_company.html',
-            company=comp,
-            agents=agents,
-            prepaid=prepaid,
-            postpaid=postpaid,
-            bills=bills
+            company=data['company'],
+            agents=pages['agents']['rows'],
+            prepaid=pages['prepaid']['rows'],
+            postpaid=pages['postpaid']['rows'],
+            pages=pages,
+            q=data['q']
         )
 
     if role == 'agent':
-        # Derive location prefix same as company
-        location = u.get('location', 'other').lower()
-
-        if location in ('rajshahi', 'nesco'):
-            prefix = 'Nesco'
-        elif location in ('dhaka', 'desco'):
-            prefix = 'Desco'
-        else:
-            prefix = 'PBS'
-
-        # Load distributed DBs
-        db_list = []
-        if client is not None:
-            for suf in ('1', '2', '3'):
-                try:
-                    db_list.append(client[f"{prefix}{suf}"])
-                except Exception:
-                    continue
-
-        # Collect bills from all DB shards
-        bills = []
-        for db in db_list:
-            cols = get_collections(db)
-            bill_col = cols.get('Bill')
-            if bill_col is not None:
-                try:
-                    bills.extend(list(bill_col.find({})))  # <-- NO FILTER
-                except Exception:
-                    pass
-
-        return render_template('dashboard_agent.html', bills=bills)
+        data = agent_bills_data(u, request.args)
+        flash_partial(data['failed_shards'])
+        return render_template('dashboard_agent.html', bills=data['bills'], next_cursor=data['next_cursor'])
 
     # Customer role logic
-    db = get_db_for_location(u.get('location', 'other'), u['id']) if client is not None else None
-    cols = get_collections(db)
-    profile = None
-    pp_col = cols.get('Prepaid')
-    if pp_col is not None:
-        profile = pp_col.find_one({'id': u['id']})
-
-    if profile is None:
-        po_col = cols.get('Postpaid')
-        if po_col is not None:
-            profile = po_col.find_one({'id': u['id']})
+    return render_template('dashboard_customer.html', **customer_dashboard_data(u, history_requested()))
+
+# ---- JSON API ----
+# Read-only mirrors of the dashboards. Each body is encoded once and carries
+# an ETag (sha1 of the body); a poll with a matching If-None-Match gets an
+# empty 304 instead of the payload. Region-wide lists are served as keyset
+# pages (?after=<next>&limit=, at most API_PAGE_MAX rows), so no body holds a
+# whole region.
+API_PAGE_MAX = int(os.getenv("API_PAGE_MAX", "1000"))
+def _json_default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, datetime):
+        return o.isoformat()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+def api_response(data):
+    body = json.dumps(data, default=_json_default).encode()
+    etag = hashlib.sha1(body).hexdigest()
+    if request.if_none_match.contains(etag):
+        return app.response_class(status=304, headers={'ETag': f'"{etag}"'})
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp
+
+def api_auth(roles=None):
+    def dec(f):
+        @wraps(f)
+        def wrapper(*a, **kw):
+            u = session.get('user')
+            if not u:
+                return jsonify(error="login required"), 401
+            if roles and u.get('user_type') not in roles:
+                return jsonify(error="access denied"), 403
+            return f(*a, **kw)
+        return wrapper
+    return dec
 
-    bill_col = cols.get('Bill')
-    bills = list(bill_col.find({'id': u['id']})) if bill_col is not None else []
+@app.route('/api/dashboard')
+@api_auth()
+def api_dashboard():
+    u = session['user']
+    role = u['user_type']
+    if role == 'admin':
+        return api_response(admin_dashboard_data())
+    if role == 'company':
+        return api_response(company_dashboard_data(u, request.args))
+    if role == 'agent':
+        return api_response(agent_bills_data(u, request.args))
+    return api_response(customer_dashboard_data(u, history_requested()))
 
-    return render_template('dashboard_customer.html', profile=profile, bills=bills)
+@app.route('/api/bills')
+@api_auth(['agent', 'customer_prepaid', 'customer_postpaid'])
+def api_bills():
+    u = session['user']
+    if u['user_type'] == 'agent':
+        return api_response(agent_bills_data(u, request.args))
+    return api_response({'bills': customer_dashboard_data(u, history_requested())['bills']})
+
+@app.route('/api/postpaid_outstanding')
+@api_auth(['company'])
+def api_postpaid_outstanding():
+    """One keyset page of the region's postpaid users; pass next back as ?after=."""
+    prefix = region_prefix(session['user'].get('location', 'other'))
+    after = request.args.get('after', type=int)
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), API_PAGE_MAX))
+
+    async def aload(cols):
+        return await apostpaid_outstanding(cols, after, limit), 0
+    results, failed = fan_out(prefix, lambda cols: (postpaid_outstanding(cols, after, limit), 0), aquery=aload)
+    users, next_cursor, _ = merge_pages(list(results.values()), limit)
+    return api_response({'failed_shards': failed, 'users': users, 'next': next_cursor})
+
+@app.route('/api/shard_summary')
+@api_auth(['admin'])
+def api_shard_summary():
+    summary, refreshed_at = get_shard_stats()
+    return api_response({'refreshed_at': datetime.fromtimestamp(refreshed_at), 'summary': summary})
 
 #####
 @app.route('/admin/create_company', methods=['GET','POST'])
@@ -364,10 +2977,11 @@ def admin_create_company():
         except Exception:
             flash("Invalid company id", "error")
             return redirect(url_for('dashboard'))
-        doc = {'id': new_id, 'user_type': 'company', 'location': data.get('location','other'), 'password': generate_password_hash(data['password'])}
+        doc = {'id': new_id, 'user_type': 'company', 'location': data.get('location','other'), 'password': hash_password(data['password'])}
         company_coll_obj = company_coll()
         if company_coll_obj is not None:
             company_coll_obj.update_one({'id': new_id}, {'$set': doc}, upsert=True)
+            sync_identity('company', new_id, doc['password'], doc['location'])
             flash("Company user created", "success")
         else:
             flash("Database connection error", "error")
@@ -387,11 +3001,12 @@ def admin_edit_company(company_id):
         data = request.form
         update = {}
         if data.get('password'):
-            update['password'] = generate_password_hash(data['password'])
+            update['password'] = hash_password(data['password'])
         if data.get('location'):
             update['location'] = data['location']
         if company_coll_obj is not None:
             company_coll_obj.update_one({'id': company_id}, {'$set': update})
+            sync_identity('company', company_id, update.get('password'), update.get('location'))
             flash("Company updated", "success")
         else:
             flash("Database connection error", "error")
@@ -427,7 +3042,7 @@ def company_create_user():
             'id': new_id,
             'name': name,
             'location': company_location,
-            'password': generate_password_hash(data['password']),
+            'password': hash_password(data['password']),
             'user_type': role
         }
 
@@ -435,6 +3050,7 @@ def company_create_user():
             agent_col = cols.get('Agent')
             if agent_col is not None:
                 agent_col.update_one({'id': new_id}, {'$set': doc}, upsert=True)
+                sync_identity('agent', new_id, doc['password'], company_location, db.name)
             else:
                 flash("Agent collection not available", "error")
                 return redirect(url_for('dashboard'))
@@ -443,22 +3059,13 @@ def company_create_user():
             customer_type = data.get('customer_type', 'prepaid')
             doc['customer_type'] = customer_type
 
-            # Generate meter number (safer lower-case handling)
-            prefix_map = {'dhaka': 'DH', 'rajshahi': 'RH', 'other': 'AL'}
-            prefix = prefix_map.get(company_location.lower(), 'AL')
+            # Allocate meter number from the region's atomic sequence
             meter_col = cols.get('Meter_inf')
-            last_number = 0
-            if meter_col is not None:
-                try:
-                    last_meter = meter_col.find_one(sort=[("meter_no", -1)])
-                    if last_meter and 'meter_no' in last_meter:
-                        try:
-                            last_number = int(last_meter['meter_no'].split('_')[-1])
-                        except Exception:
-                            last_number = 0
-                except Exception:
-                    last_number = 0
-            meter_no = f"{prefix}_{last_number + 1:06d}"
+            try:
+                meter_no = next_meter_no(meter_prefix(company_location))
+            except Exception:
+                flash("Could not allocate a meter number", "error")
+                return redirect(url_for('dashboard'))
             doc['meter_no'] = meter_no
 
             # Create Meter_info document
@@ -480,14 +3087,17 @@ def company_create_user():
                 pp_col = cols.get('Prepaid')
                 if pp_col is not None:
                     pp_col.update_one({'id': new_id}, {'$set': doc}, upsert=True)
+                    sync_identity('customer_prepaid', new_id, doc['password'], company_location, db.name)
                 else:
                     flash("Prepaid collection not available", "error")
                     return redirect(url_for('dashboard'))
             else:  # postpaid
-                doc['due_date'] = data.get('due_date')
+                doc['due_date'] = parse_due_date(data.get('due_date'))
                 po_col = cols.get('Postpaid')
                 if po_col is not None:
                     po_col.update_one({'id': new_id}, {'$set': doc}, upsert=True)
+                    write_accounts(cols, [account_profile_op(doc)])
+                    sync_identity('customer_postpaid', new_id, doc['password'], company_location, db.name)
                 else:
                     flash("Postpaid collection not available", "error")
                     return redirect(url_for('dashboard'))
@@ -497,6 +3107,26 @@ def company_create_user():
 
     return render_template('company_create_user.html')
 
+@app.route('/company/import_users', methods=['GET', 'POST'])
+@login_required
+@role_required(['company'])
+def company_import_users():
+    report = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if get_client() is None:
+            flash("Database connection error", "error")
+            return redirect(url_for('dashboard'))
+        if upload is None or not upload.filename:
+            flash("Choose a CSV or NDJSON file", "error")
+            return redirect(url_for('company_import_users'))
+        fmt = 'ndjson' if upload.filename.endswith(('.ndjson', '.jsonl')) else 'csv'
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8', newline='')
+        report = import_users(session['user'].get('location', 'other'), stream, fmt)
+        flash(f"Imported {report['imported']} rows ({report['rows_per_sec']} rows/s), "
+              f"{len(report['errors'])} errors", "success" if not report['errors'] else "error")
+    return render_template('company_import_users.html', report=report)
+
 #update user
 @app.route('/company/company_update_user/<user_type>/<int:user_id>', methods=['GET', 'POST'])
 @login_required
@@ -529,9 +3159,13 @@ def company_update_user(user_type, user_id):
         if data.get('name'):
             update_doc['name'] = data['name']
         if data.get('password'):
-            update_doc['password'] = generate_password_hash(data['password'])
+            update_doc['password'] = hash_password(data['password'])
         if update_doc:
             cols[collection].update_one({'id': user_id}, {'$set': update_doc})
+            if collection == 'Postpaid' and 'name' in update_doc:
+                write_accounts(cols, [account_profile_op(dict(user, **update_doc))])
+            if 'password' in update_doc:
+                sync_identity(SHARD_ROLES[collection], user_id, update_doc['password'], db_name=db.name)
             flash("User updated successfully", "success")
         return redirect(url_for('dashboard'))
 
@@ -569,7 +3203,7 @@ def company_edit_user(user_id):
         data = request.form
         update = {}
         if data.get('password'):
-            update['password'] = generate_password_hash(data['password'])
+            update['password'] = hash_password(data['password'])
         if 'balance' in data and data.get('balance')!='':
             try:
                 update['balance'] = float(data.get('balance') or 0)
@@ -581,17 +3215,16 @@ def company_edit_user(user_id):
             except Exception:
                 update['bill_amount'] = 0
         if user_doc.get('user_type') == 'agent':
-            agent_col = cols.get('Agent')
-            if agent_col is not None:
-                agent_col.update_one({'id': user_id}, {'$set': update})
+            col_name = 'Agent'
         elif user_doc.get('customer_type') == 'prepaid':
-            pp_col = cols.get('Prepaid')
-            if pp_col is not None:
-                pp_col.update_one({'id': user_id}, {'$set': update})
+            col_name = 'Prepaid'
         else:
-            po_col = cols.get('Postpaid')
-            if po_col is not None:
-                po_col.update_one({'id': user_id}, {'$set': update})
+            col_name = 'Postpaid'
+        target_col = cols.get(col_name)
+        if target_col is not None:
+            target_col.update_one({'id': user_id}, {'$set': update})
+            if 'password' in update:
+                sync_identity(SHARD_ROLES[col_name], user_id, update['password'], db_name=db.name)
         flash("Updated", "success")
         return redirect(url_for('dashboard'))
     return render_template('company_edit_user.html', target=user_doc)
@@ -602,60 +3235,11 @@ def company_edit_user(user_id):
 @role_required(['company'])
 def company_postpaid_users():
     u = session['user']
-    location = u.get('location', 'other').lower()
-
-    # Determine DB prefix
-    if location in ('rajshahi', 'nesco'):
-        prefix = 'Nesco'
-    elif location in ('dhaka', 'desco'):
-        prefix = 'Desco'
-    else:
-        prefix = 'PBS'
+    prefix = region_prefix(u.get('location', 'other'))
 
     # Collect from all shards
-    db_list = []
-    if client is not None:
-        for suf in ('1','2','3'):
-            try:
-                db_list.append(client[f"{prefix}{suf}"])
-            except Exception:
-                continue
-
-    final_users = []
-    for db in db_list:
-        cols = get_collections(db)
-        postpaid_col = cols.get('Postpaid')
-        bill_col = cols.get('Bill')
-        users = []
-        if postpaid_col is not None:
-            try:
-                users = list(postpaid_col.find({}))
-            except Exception:
-                users = []
-        for user in users:
-            uid = user.get('id')
-            unpaid = None
-            if bill_col is not None:
-                try:
-                    unpaid = bill_col.find_one({"id": uid, "status": "unpaid"})
-                except Exception:
-                    unpaid = None
-
-            outstanding = 0
-            fine = 0
-
-            if unpaid:
-                outstanding = unpaid.get("amount", 0)
-                fine = 50  # auto rule
-
-            final_users.append({
-                "id": uid,
-                "name": user.get("name"),
-                "meter_no": user.get("meter_no"),
-                "location": user.get("location"),
-                "outstanding": outstanding,
-                "fine": fine
-            })
+    final_users, failed = fan_out_list(prefix, postpaid_outstanding, aquery=apostpaid_outstanding)
+    flash_partial(failed)
 
     return render_template("company_postpaid_users.html", users=final_users)
 
@@ -675,8 +3259,9 @@ def company_bill_user(user_id):
         flash("Postpaid collection not available", "danger")
         return redirect(url_for('company_postpaid_users'))
 
-    # Load postpaid user
-    user = po_col.find_one({"id": user_id}) if po_col is not None else None
+    # Load the account summary: profile and latest bill in one document
+    account = cols['Account'].find_one({"_id": user_id})
+    user = account or po_col.find_one({"id": user_id}, ACCOUNT_PROJECTION)
     if not user:
         flash("User not found", "danger")
         return redirect(url_for('company_postpaid_users'))
@@ -684,8 +3269,9 @@ def company_bill_user(user_id):
     bill_col = cols.get('Bill')
 
     # ---- Get latest bill (only 1) ----
-    old_bill = None
-    if bill_col is not None:
+    old_bill = account.get('last_bill') if account else None
+    if account is None and bill_col is not None:
+        # no summary yet (before 'flask rebuild-accounts'): read the bills
         try:
             old_bill = bill_col.find_one(
                 {"id": user_id},
@@ -694,40 +3280,22 @@ def company_bill_user(user_id):
         except Exception:
             old_bill = None
 
-    # Default values
-    old_amount = 0
-    fine = 0
-
-    # ---- If there is an old bill ----
-    if old_bill:
-        old_amount = float(old_bill.get("amount", 0) or 0)
-
-        # fine only if old bill status is unpaid
-        if old_bill.get("status") == "unpaid":
-            fine = 50
-        else:
-            fine = 0  # paid or replaced
+    old_amount, fine = carry_forward(old_bill)
+    # slab tariff on the units not billed yet, used when no amount is typed in
+    meter = po_col.find_one({"id": user_id}, {"meter_no": 1, "billed_units": 1}) or {}
+    (reading,), (units,) = unbilled_usage(cols, [meter], 'billed_units')
+    tariff_amount = tariff_charges([dict(user, id=user_id, location=location)], [units], 'postpaid')[0]
 
     # ---- Handle POST request ----
     if request.method == "POST":
         try:
-            new_amount = float(request.form.get("amount") or 0)
+            new_amount = float(request.form.get("amount") or tariff_amount)
         except Exception:
             new_amount = 0
         due_date = request.form.get("due_date")
 
-        total = new_amount + old_amount + fine
-
-        new_bill = {
-            "id": user_id,
-            "location": location,
-            "amount": total,
-            "due_date": due_date,
-            "status": "unpaid",
-            "fine": fine,
-            "base_amount": new_amount,
-            "previous_due": old_amount
-        }
+        new_bill = build_bill(user_id, location, new_amount, due_date, old_bill)
+        new_bill["meter_reading"] = reading
 
         if bill_col is not None:
             try:
@@ -735,6 +3303,11 @@ def company_bill_user(user_id):
             except Exception:
                 flash("Failed to create bill", "error")
                 return redirect(url_for('company_postpaid_users'))
+            po_col.bulk_write([billed_mark_op(user_id, reading)])
+            try:
+                write_accounts(cols, [account_bill_op(user, new_bill)])
+            except Exception:
+                pass  # 'flask rebuild-accounts' repairs the summary
 
             # mark old bill as replaced (only if old exists and only if unpaid)
             if old_bill and old_bill.get("status") == "unpaid":
@@ -753,7 +3326,8 @@ def company_bill_user(user_id):
         "company_bill_user.html",
         user=user,
         old_amount=old_amount,
-        fine=fine
+        fine=fine,
+        tariff_amount=tariff_amount
     )
 
 #agent
@@ -777,30 +3351,65 @@ def agent_pay():
         flash("Database connection error", "error")
         return redirect(url_for('dashboard'))
         
-    cols = get_collections(db)
-    pp_col = cols.get('Prepaid')
-    bill_col = cols.get('Bill')
+    try:
+        result = apply_payment(get_collections(db), user_id, amount)
+    except Exception:
+        flash("Failed to apply payment", "error")
+        return redirect(url_for('dashboard'))
+    if result == 'recharged':
+        flash("Recharged prepaid account", "success")
+    elif result == 'bill_paid':
+        flash("Marked a bill as paid", "success")
+    else:
+        flash("No target found to pay", "error")
+    return redirect(url_for('dashboard'))
 
-    prepaid = pp_col.find_one({'id': user_id}) if pp_col is not None else None
-    if prepaid:
-        new_balance = (prepaid.get('balance') or 0) + amount
+@app.route('/agent/pay_batch', methods=['POST'])
+@login_required
+@role_required(['agent'])
+def agent_pay_batch():
+    """JSON body {"payments": [{"key": ..., "user_id": ..., "amount": ...}, ...]}."""
+    u = session['user']
+    if get_client() is None:
+        return jsonify(error="Database connection error"), 503
+    payments = (request.get_json(silent=True) or {}).get('payments')
+    if not isinstance(payments, list) or not payments:
+        return jsonify(error="payments must be a non-empty list"), 400
+    if len(payments) > PAYMENT_BATCH_MAX:
+        return jsonify(error=f"at most {PAYMENT_BATCH_MAX} payments per request"), 400
+
+    results = {}
+    by_shard = {}
+    seen = set()
+    for i, p in enumerate(payments):
+        key = str((p or {}).get('key') or '').strip()
+        if key in seen:
+            continue
         try:
-            pp_col.update_one({'id': user_id}, {'$set': {'balance': new_balance}})
-            flash("Recharged prepaid account", "success")
+            payment = {'key': key, 'user_id': int(p['user_id']), 'amount': float(p['amount'])}
         except Exception:
-            flash("Failed to update balance", "error")
-        return redirect(url_for('dashboard'))
-
-    unpaid = bill_col.find_one({'id': user_id, 'status': 'unpaid'}) if bill_col is not None else None
-    if unpaid:
+            payment = None
+        if payment is not None and not (math.isfinite(payment['amount']) and payment['amount'] > 0):
+            payment = None
+        if not key or payment is None:
+            results[key or f"#{i}"] = 'invalid'
+            continue
+        seen.add(key)
+        by_shard.setdefault(choose_db(u.get('location', 'other'), payment['user_id']), []).append(payment)
+
+    failed = []
+    futures = {dbn: submit_shard(apply_payment_batch, get_collections(get_client()[dbn]), shard_payments, u['id'],
+                                 job=True)
+               for dbn, shard_payments in by_shard.items()}
+    # a shard still working is reported failed; its keys make a retry safe
+    wait_shards(futures.values(), PAYMENT_BATCH_TIMEOUT)
+    for dbn, fut in futures.items():
         try:
-            bill_col.update_one({'_id': unpaid['_id']}, {'$set': {'status': 'paid'}})
-            flash("Marked a bill as paid", "success")
+            results.update(fut.result(timeout=0))
         except Exception:
-            flash("Failed to mark bill paid", "error")
-        return redirect(url_for('dashboard'))
-    flash("No target found to pay", "error")
-    return redirect(url_for('dashboard'))
+            failed.append(dbn)
+            results.update({p['key']: 'failed' for p in by_shard[dbn]})
+    return jsonify(results=results, failed_shards=failed)
 
 @app.route('/admin/delete_company/<int:company_id>', methods=['POST'])
 @login_required
@@ -810,6 +3419,7 @@ def admin_delete_company(company_id):
     if company_coll_obj is not None:
         try:
             company_coll_obj.delete_one({'id': company_id})
+            remove_identity(company_id, ['company'])
             flash("Company removed", "success")
         except Exception:
             flash("Failed to remove company", "error")
@@ -817,6 +3427,31 @@ def admin_delete_company(company_id):
         flash("Database connection error", "error")
     return redirect(url_for('dashboard'))
 
+@app.route('/admin/billing_run', methods=['POST'])
+@login_required
+@role_required(['admin'])
+def admin_billing_run():
+    data = request.form
+    period = (data.get('period') or '').strip()
+    try:
+        # blank amount: charge each customer's slab tariff
+        amounts_for = flat_amount(float(data['amount'])) if data.get('amount') else tariff_amounts('postpaid')
+    except Exception:
+        flash("Invalid amount", "error")
+        return redirect(url_for('dashboard'))
+    if get_client() is None or not period:
+        flash("Database connection error" if get_client() is None else "Billing period is required", "error")
+        return redirect(url_for('dashboard'))
+    prefix = region_prefix(data.get('region'))
+    if not claim_billing_run(prefix, period):
+        flash(f"A billing run for {prefix} {period} is already in progress", "error")
+        return redirect(url_for('dashboard'))
+    # runs in the background; its progress is shown under Monthly Billing Run
+    threading.Thread(target=_run_billing_bg, args=(prefix, period, data.get('due_date'), amounts_for),
+                     daemon=True).start()
+    flash(f"Billing run for {prefix} {period} started", "success")
+    return redirect(url_for('dashboard'))
+
 @app.route('/company/delete_user/<int:user_id>', methods=['POST'])
 @login_required
 @role_required(['company'])
@@ -841,12 +3476,24 @@ def company_delete_user(user_id):
         if po_col is not None:
             try:
                 po_col.delete_one({'id': user_id})
+                cols['Account'].delete_one({'_id': user_id})
             except Exception:
                 pass
+        remove_identity(user_id, SHARD_ROLES.values(), db.name)
         flash("User deleted", "success")
     else:
         flash("Database connection error", "error")
     return redirect(url_for('dashboard'))
 
+def get_app():
+    """The module-level Flask app, for WSGI servers: gunicorn -w 4 'app:get_app()' (or 'app:app').
+
+    Settings come from the environment (MONGO_URI, MONGO_* pool options,
+    READY_TIMEOUT) when the module is imported. Importing does no I/O: every
+    worker opens its own pooled MongoClient (and shard thread pools) on first
+    use, so it is safe with or without --preload.
+    """
+    return app
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    get_app().run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,66 @@
+"""Contention benchmark for meter number allocation.
+
+Runs N concurrent "signups" against a local mongod (MONGO_URI) and compares
+the old find-max-then-add-one scheme with the atomic counter at several
+block sizes. Reports allocations/sec and duplicate numbers handed out.
+
+    python benchmarks/bench_meter_allocator.py [signups] [threads]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+BENCH_DB = "bench_meter_allocator"
+PREFIX = "BX"
+
+
+def find_max_allocator(meter_col):
+    def allocate():
+        last = meter_col.find_one(sort=[("meter_no", -1)])
+        last_number = int(last['meter_no'].split('_')[-1]) if last else 0
+        meter_no = app.format_meter_no(PREFIX, last_number + 1)
+        meter_col.insert_one({'meter_no': meter_no})
+        return meter_no
+    return allocate
+
+
+def counter_allocator(block_size):
+    def allocate():
+        return app.next_meter_no(PREFIX)
+    app.METER_BLOCK_SIZE = block_size
+    app._meter_blocks.clear()
+    app.counters_coll().delete_one({'_id': f'meter:{PREFIX}'})
+    return allocate
+
+
+def run(name, allocate, signups, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        meters = list(pool.map(lambda _: allocate(), range(signups)))
+    elapsed = time.perf_counter() - start
+    dupes = len(meters) - len(set(meters))
+    print(f"{name:<22} {signups / elapsed:>10.0f}/s {dupes:>8} duplicates")
+
+
+def main(signups, threads):
+    if app.get_client() is None:
+        sys.exit("Could not create a MongoDB client for " + app.MONGO_URI)
+    meter_col = app.get_client()[BENCH_DB]['Meter_inf']
+    meter_col.drop()
+    print(f"{signups} signups on {threads} threads")
+    try:
+        run("find max + 1", find_max_allocator(meter_col), signups, threads)
+        for block_size in (1, 20, 100):
+            run(f"counter, block={block_size}", counter_allocator(block_size), signups, threads)
+    finally:
+        app.get_client().drop_database(BENCH_DB)
+        app.counters_coll().delete_one({'_id': f'meter:{PREFIX}'})
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if args else 2000, args[1] if len(args) > 1 else 16)
@@ -0,0 +1,48 @@
+"""Login hashing throughput for candidate PASSWORD_HASH_METHOD policies.
+
+Times check_password_hash (the per-login cost) for each policy, single
+threaded and across worker processes, so the security/throughput trade-off
+can be picked from numbers. Needs no database.
+
+    python benchmarks/bench_password_policy.py [workers] [policy ...]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_POLICIES = [
+    "scrypt",
+    "scrypt:16384:8:1",
+    "pbkdf2:sha256:1000000",
+    "pbkdf2:sha256:600000",
+    "pbkdf2:sha256:260000",
+]
+PASSWORD = "correct horse battery staple"
+
+
+def logins_per_sec(pwhash, seconds=2.0):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        check_password_hash(pwhash, PASSWORD)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main(workers, policies):
+    print(f"{'policy':<24} {'1 proc (/s)':>12} {f'{workers} procs (/s)':>14}")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for method in policies:
+            pwhash = generate_password_hash(PASSWORD, method=method)
+            single = logins_per_sec(pwhash)
+            parallel = sum(pool.map(logins_per_sec, [pwhash] * workers))
+            print(f"{method:<24} {single:>12.1f} {parallel:>14.1f}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    workers = int(args.pop(0)) if args and args[0].isdigit() else (os.cpu_count() or 1)
+    main(workers, args or DEFAULT_POLICIES)
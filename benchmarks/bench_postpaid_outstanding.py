@@ -0,0 +1,68 @@
+"""Benchmark the postpaid outstanding view: per-user find_one (N+1) vs the Account summaries.
+
+Runs against a local mongod (MONGO_URI, default mongodb://127.0.0.1:27017)
+and uses a throwaway database that is dropped afterwards.
+
+    python benchmarks/bench_postpaid_outstanding.py [1000 10000 100000]
+"""
+import os
+import sys
+import time
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import get_collections, postpaid_outstanding, rebuild_accounts  # noqa: E402
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017")
+BENCH_DB = "bench_postpaid_outstanding"
+
+
+def seed(db, n):
+    db['Postpaid'].drop()
+    db['Bill'].drop()
+    db['Account'].drop()
+    db['Postpaid'].insert_many(
+        [{'id': i, 'name': f'user{i}', 'meter_no': f'AL_{i:06d}', 'location': 'other'} for i in range(1, n + 1)]
+    )
+    # every other customer has an unpaid bill, the rest a paid one
+    db['Bill'].insert_many(
+        [{'id': i, 'amount': 100.0, 'status': 'unpaid' if i % 2 else 'paid'} for i in range(1, n + 1)]
+    )
+    db['Bill'].create_index([('id', 1), ('status', 1)])
+    db['Bill'].create_index([('id', 1), ('_id', -1)])
+    rebuild_accounts(get_collections(db))
+
+
+def n_plus_one(cols):
+    rows = []
+    for user in cols['Postpaid'].find({}):
+        unpaid = cols['Bill'].find_one({"id": user.get('id'), "status": "unpaid"})
+        rows.append({"id": user.get('id'), "outstanding": unpaid.get("amount", 0) if unpaid else 0})
+    return rows
+
+
+def timed(fn, cols):
+    start = time.perf_counter()
+    rows = fn(cols)
+    return time.perf_counter() - start, len(rows)
+
+
+def main(sizes):
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+    db = client[BENCH_DB]
+    cols = get_collections(db)
+    print(f"{'users':>8} {'n+1 (s)':>10} {'summary (s)':>12} {'speedup':>8}")
+    try:
+        for n in sizes:
+            seed(db, n)
+            old, old_rows = timed(n_plus_one, cols)
+            new, new_rows = timed(postpaid_outstanding, cols)
+            assert old_rows == new_rows == n
+            print(f"{n:>8} {old:>10.3f} {new:>12.3f} {old / new:>7.1f}x")
+    finally:
+        client.drop_database(BENCH_DB)
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,40 @@
+"""Slab tariff throughput: per-meter Python loop vs the vectorized engine.
+
+Computes charges for N random meter readings with the default postpaid
+tariff, once per meter with _slab_charge() and once with slab_charges()
+(NumPy when installed), and checks both agree. Needs no database.
+
+    python benchmarks/bench_tariff.py [1000000 ...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main(sizes):
+    tariff = app.DEFAULT_TARIFFS['Nesco']['postpaid']
+    fixed = tariff['fixed']
+    rng = random.Random(42)
+    engine = "numpy" if app.np is not None else "python fallback"
+    print(f"vectorized engine: {engine}")
+    print(f"{'meters':>9} {'loop (s)':>10} {'vector (s)':>11} {'meters/s':>12} {'speedup':>8}")
+    for n in sizes:
+        units = [rng.uniform(0, 900) for _ in range(n)]
+        loop, expected = timed(lambda: [app._slab_charge(u, tariff['slabs']) + fixed for u in units])
+        vector, charges = timed(app.slab_charges, units, tariff)
+        assert all(abs(a - b) < 0.02 for a, b in zip(expected, charges))
+        print(f"{n:>9} {loop:>10.3f} {vector:>11.3f} {n / vector:>12.0f} {loop / vector:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000])
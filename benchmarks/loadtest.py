@@ -0,0 +1,258 @@
+"""Scripted load test of the app against data from benchmarks/seed_data.py.
+
+Scenarios: login for each role, each role's dashboard, the company postpaid
+list, bill generation and single/batched agent payments. Each one runs
+--requests requests from --concurrency clients and reports req/s, p50/p95/p99
+latency and database queries per request (the X-DB-Queries header). Results
+go to benchmarks/results/<label>-<timestamp>.json; --compare prints the change
+against an earlier result file.
+
+By default it starts the app itself (flask run, threaded) on --port; pass
+--base-url to test a server you started, e.g. under gunicorn.
+
+    python benchmarks/seed_data.py --drop
+    python benchmarks/loadtest.py --label baseline
+    python benchmarks/loadtest.py --label change --compare benchmarks/results/baseline-....json
+"""
+import argparse
+import http.cookiejar
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+ROLES = ('admin', 'company', 'agent', 'customer_prepaid', 'customer_postpaid')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # time each request on its own, not the page it redirects to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    def __init__(self, base):
+        self.base = base
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+    def request(self, path, form=None, body=None):
+        """(status, seconds, queries) for one request."""
+        data, headers = None, {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        elif body is not None:
+            data, headers = json.dumps(body).encode(), {'Content-Type': 'application/json'}
+        req = urllib.request.Request(self.base + path, data=data, headers=headers)
+        start = time.perf_counter()
+        try:
+            resp = self.opener.open(req, timeout=60)
+            resp.read()
+        except urllib.error.HTTPError as e:
+            resp = e
+            resp.read()
+        self.location = resp.headers.get('Location') or ''
+        return resp.status, time.perf_counter() - start, int(resp.headers.get('X-DB-Queries') or 0)
+
+    def login(self, user_id, password, location):
+        """True if the app accepted the credentials (it redirects to the dashboard)."""
+        self.request('/login', {'user_id': user_id, 'password': password, 'location': location})
+        return self.location.endswith('/dashboard')
+
+
+def users(manifest):
+    """(role, id, location) for every seeded account."""
+    yield 'admin', manifest['admin'], 'admin'
+    for region in manifest['regions'].values():
+        yield 'company', region['company'], region['location']
+        for role in ROLES[2:]:
+            if region[role]:
+                first, last = region[role]
+                for user_id in range(first, last + 1):
+                    yield role, user_id, region['location']
+
+
+def scenarios(manifest, rng):
+    """name -> (login role or None, factory(client) returning (path, form, body))."""
+    accounts = {}
+    for role, user_id, location in users(manifest):
+        accounts.setdefault(role, []).append((user_id, location))
+    password = manifest['password']
+    period = datetime.now().strftime('%Y-%m')
+    keys = itertools.count()
+    out = {}
+    for role in ROLES:
+        if accounts.get(role):
+            out[f'login_{role}'] = (None, lambda c, r=role: ('/login', dict(
+                zip(('user_id', 'location'), rng.choice(accounts[r])), password=password), None))
+            out[f'dashboard_{role}'] = (role, lambda c: ('/dashboard', None, None))
+    out['company_postpaid_users'] = ('company', lambda c: ('/company/postpaid_users', None, None))
+    out['bill_generation'] = ('company', lambda c: (
+        f"/company/bill_user/{rng.choice(c.region['customer_postpaid_ids'])}",
+        {'amount': round(rng.uniform(300, 3000), 2), 'due_date': f'{period}-28'}, None))
+    out['agent_pay'] = ('agent', lambda c: (
+        '/agent/pay', {'user_id': rng.choice(c.region['customer_prepaid_ids']), 'amount': 100}, None))
+    out['agent_pay_batch'] = ('agent', lambda c: ('/agent/pay_batch', None, {'payments': [
+        {'key': f'bench-{os.getpid()}-{next(keys)}', 'user_id': rng.choice(c.region['customer_prepaid_ids']),
+         'amount': 10} for _ in range(20)]}))
+    return out, accounts
+
+
+def region_of(manifest, location):
+    for region in manifest['regions'].values():
+        if region['location'] == location:
+            return {f'{role}_ids': list(range(region[role][0], region[role][1] + 1)) if region[role] else [0]
+                    for role in ROLES[2:]}
+    return {f'{role}_ids': [0] for role in ROLES[2:]}
+
+
+def run_scenario(base, manifest, accounts, role, factory, requests, concurrency, rng):
+    samples = []
+    lock = threading.Lock()
+    remaining = itertools.count()
+
+    def worker():
+        client = Client(base)
+        if role is not None:
+            user_id, location = rng.choice(accounts[role])
+            if not client.login(user_id, manifest['password'], location):
+                print(f"login failed for {role} {user_id}; was the database seeded?", file=sys.stderr)
+                with lock:
+                    samples.append((0, 0.0, 0))
+                return
+            client.region = region_of(manifest, location)
+        while next(remaining) < requests:
+            try:
+                path, form, body = factory(client)
+                sample = client.request(path, form, body)
+            except OSError:
+                sample = (0, 0.0, 0)
+            with lock:
+                samples.append(sample)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(samples, time.perf_counter() - start)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def summarize(samples, elapsed):
+    ok = sorted(s for status, s, _ in samples if 0 < status < 400)
+    queries = [q for status, _, q in samples if 0 < status < 400]
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'req_per_sec': round(len(samples) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(ok, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(ok, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(ok, 0.99) * 1000, 2),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else 0,
+        'max_queries': max(queries, default=0),
+    }
+
+
+def start_server(port):
+    env = dict(os.environ, ENSURE_INDEXES='0')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/healthz', timeout=1)
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit(f"server on port {port} did not start")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def print_table(results, baseline=None):
+    print(f"{'scenario':<28} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'q/req':>6} {'err':>5}")
+    for name, r in results.items():
+        line = (f"{name:<28} {r['req_per_sec']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+                f"{r['queries_per_request']:>6} {r['errors']:>5}")
+        old = (baseline or {}).get(name)
+        if old and old['p95_ms']:
+            line += (f"   p95 {100 * (r['p95_ms'] - old['p95_ms']) / old['p95_ms']:+.0f}%"
+                     f"  req/s {r['req_per_sec'] - old['req_per_sec']:+.1f}"
+                     f"  q/req {r['queries_per_request'] - old['queries_per_request']:+.2f}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--manifest', default=os.path.join(RESULTS_DIR, 'seed.json'))
+    parser.add_argument('--base-url')
+    parser.add_argument('--port', type=int, default=5111)
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--scenario', action='append', help='run only these (repeatable)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default='run')
+    parser.add_argument('--compare', help='earlier result file to diff against')
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    rng = random.Random(args.seed)
+    todo, accounts = scenarios(manifest, rng)
+    if args.scenario:
+        todo = {name: todo[name] for name in args.scenario}
+
+    proc = None if args.base_url else start_server(args.port)
+    base = args.base_url or f'http://127.0.0.1:{args.port}'
+    results = {}
+    try:
+        for name, (role, factory) in todo.items():
+            results[name] = run_scenario(base, manifest, accounts, role, factory,
+                                         args.requests, args.concurrency, rng)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_table(results, baseline)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = os.path.join(RESULTS_DIR, f"{args.label}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out, 'w') as f:
+        json.dump({'label': args.label, 'commit': git_commit(), 'at': datetime.now().isoformat(),
+                   'params': {'requests': args.requests, 'concurrency': args.concurrency, 'seed': args.seed,
+                              'base_url': base, 'async_mongo': os.getenv('ASYNC_MONGO', '0')},
+                   'volumes': manifest['volumes'], 'results': results}, f, indent=2)
+    print(f"results written to {out}")
+
+
+if __name__ == '__main__':
+    main()
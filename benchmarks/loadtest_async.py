@@ -0,0 +1,110 @@
+"""Load test the fan-out routes with and without ASYNC_MONGO.
+
+Starts the app twice on a local mongod (MONGO_URI), once with the thread
+pool fan-out and once with ASYNC_MONGO=1, logs in as the given user and
+hammers the given paths with concurrent clients. Reports requests/sec and
+p50/p99 latency for each build.
+
+Both builds are the same threaded WSGI server, one thread per in-flight
+request. The comparison is only between the shard fan-out strategies:
+SHARD_QUERY_WORKERS pool threads per process versus one asyncio loop
+multiplexing every shard query. It does not measure an async (ASGI) server.
+
+    python benchmarks/loadtest_async.py --user 2 --password secret \\
+        --path /dashboard --path /company/postpaid_users --clients 32 --seconds 20
+"""
+import argparse
+import http.cookiejar
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(port, async_mode):
+    env = dict(os.environ, ASYNC_MONGO='1' if async_mode else '0', ENSURE_INDEXES='0')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1)
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit(f"server on port {port} did not start")
+
+
+def logged_in_opener(base, args):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    form = urllib.parse.urlencode({'user_id': args.user, 'password': args.password,
+                                   'location': args.location}).encode()
+    opener.open(base + '/login', form)
+    return opener
+
+
+def run_load(base, args):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def client():
+        opener = logged_in_opener(base, args)
+        i = 0
+        while time.perf_counter() < deadline:
+            path = args.path[i % len(args.path)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                opener.open(base + path).read()
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+    return len(latencies) / args.seconds, pct(0.50), pct(0.99), errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--location', default='other')
+    parser.add_argument('--path', action='append', default=None)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--port', type=int, default=5101)
+    args = parser.parse_args()
+    args.path = args.path or ['/dashboard']
+
+    print(f"{'build':<8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for offset, async_mode in enumerate((False, True)):
+        port = args.port + offset
+        proc = start_server(port, async_mode)
+        try:
+            rps, p50, p99, errs = run_load(f'http://127.0.0.1:{port}', args)
+        finally:
+            proc.terminate()
+            proc.wait()
+        print(f"{'async' if async_mode else 'sync':<8} {rps:>8.1f} {p50:>8.1f} {p99:>8.1f} {errs:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Seed managementdb and every shard with synthetic, reproducible data.
+
+For each region (one company per region) creates agents, prepaid and postpaid
+customers with meters, and a multi-month bill history for postpaid customers
+(plus their Account summaries), all with bulk inserts routed through the app's shard map. The same --seed
+gives the same data. Writes a manifest (ids, password, volumes) that
+benchmarks/loadtest.py reads.
+
+Runs against a local mongod (MONGO_URI). --drop first drops managementdb and
+every shard database, so never point it at real data.
+
+    python benchmarks/seed_data.py --drop --agents 20 --prepaid 2000 --postpaid 2000 --months 6
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime
+
+from pymongo import ReplaceOne
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ENSURE_INDEXES', '0')  # created once seeding is done
+import app  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+ADMIN_ID = 1000000
+# one company per region, identified by the location its users live in
+COMPANIES = {1000001: 'rajshahi', 1000002: 'dhaka', 1000003: 'other'}
+BATCH = 5000
+
+
+def periods(months, today=None):
+    """The last `months` billing periods, oldest first, as (YYYY-MM, due date datetime)."""
+    today = today or date.today()
+    out = []
+    y, m = today.year, today.month
+    for _ in range(months):
+        out.append((f"{y:04d}-{m:02d}", datetime(y, m, 15)))
+        y, m = (y, m - 1) if m > 1 else (y - 1, 12)
+    return out[::-1]
+
+
+def bulk_insert(col, docs):
+    for i in range(0, len(docs), BATCH):
+        col.insert_many(docs[i:i + BATCH], ordered=False)
+
+
+def bill_history(rng, user_id, location, history):
+    """Paid bills for past periods; the latest one is unpaid for about half the users."""
+    bills = []
+    for n, (period, due) in enumerate(history):
+        amount = round(rng.uniform(300, 3000), 2)
+        last = n == len(history) - 1
+        bills.append({'id': user_id, 'location': location, 'period': period, 'amount': amount,
+                      'base_amount': amount, 'previous_due': 0, 'fine': 0, 'due_date': due,
+                      'status': 'unpaid' if last and rng.random() < 0.5 else 'paid'})
+    return bills
+
+
+def seed_region(rng, location, pwhash, args, history):
+    """Build and insert one region's users; returns the ids by role."""
+    ids = {
+        'agent': list(range(1, args.agents + 1)),
+        'customer_prepaid': list(range(args.agents + 1, args.agents + args.prepaid + 1)),
+        'customer_postpaid': list(range(args.agents + args.prepaid + 1,
+                                        args.agents + args.prepaid + args.postpaid + 1)),
+    }
+    meters = iter(app.reserve_meter_block(app.meter_prefix(location), args.prepaid + args.postpaid))
+    docs = {}   # (db name, collection) -> [doc]
+    identities = []
+
+    def add(dbn, col_name, doc):
+        docs.setdefault((dbn, col_name), []).append(doc)
+
+    for role, col_name in (('agent', 'Agent'), ('customer_prepaid', 'Prepaid'), ('customer_postpaid', 'Postpaid')):
+        for user_id in ids[role]:
+            dbn = app.choose_db(location, user_id)
+            doc = {'id': user_id, 'name': f'{role}{user_id}', 'location': location, 'password': pwhash,
+                   'user_type': 'agent' if role == 'agent' else 'customer'}
+            if role != 'agent':
+                doc['meter_no'] = next(meters)
+                doc['customer_type'] = 'prepaid' if role == 'customer_prepaid' else 'postpaid'
+                add(dbn, 'Meter_inf', {'meter_no': doc['meter_no'], 'location': location,
+                                       'unit_usage': round(rng.uniform(50, 800), 1)})
+            if role == 'customer_prepaid':
+                doc['balance'] = round(rng.uniform(0, 2000), 2)
+                # stored as the form's date string, like the app does
+                doc['recharge_date'] = history[-1][1].strftime('%Y-%m-%d')
+            elif role == 'customer_postpaid':
+                doc['due_date'] = history[-1][1]
+                for bill in bill_history(rng, user_id, location, history):
+                    add(dbn, 'Bill', bill)
+            add(dbn, col_name, doc)
+            identities.append(ReplaceOne(
+                {'_id': app._identity_key(role, user_id, dbn)},
+                {'id': user_id, 'role': role, 'db': dbn, 'password': pwhash, 'location': location},
+                upsert=True))
+
+    counts = {}
+    for (dbn, col_name), rows in docs.items():
+        bulk_insert(app.get_client()[dbn][col_name], rows)
+        counts[col_name] = counts.get(col_name, 0) + len(rows)
+    for i in range(0, len(identities), BATCH):
+        app.identity_coll().bulk_write(identities[i:i + BATCH], ordered=False)
+    return ids, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--agents', type=int, default=20, help='agents per region')
+    parser.add_argument('--prepaid', type=int, default=1000, help='prepaid customers per region')
+    parser.add_argument('--postpaid', type=int, default=1000, help='postpaid customers per region')
+    parser.add_argument('--months', type=int, default=6, help='bill history per postpaid customer')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--drop', action='store_true', help='drop managementdb and all shards first')
+    parser.add_argument('--manifest', default=os.path.join(RESULTS_DIR, 'seed.json'))
+    args = parser.parse_args()
+
+    client = app.get_client()
+    if client is None:
+        sys.exit("Could not create a MongoDB client for " + app.MONGO_URI)
+    if args.drop:
+        for dbn in [app.ADMIN_DB] + app.shard_db_names():
+            client.drop_database(dbn)
+        app._meter_seeded.clear()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    # one hash for everybody: hashing each synthetic user would dominate seeding
+    pwhash = app.hash_password(args.password)
+    app.admin_coll().replace_one({'id': ADMIN_ID}, {'id': ADMIN_ID, 'user_type': 'admin', 'password': pwhash},
+                                 upsert=True)
+    app.sync_identity('admin', ADMIN_ID, pwhash)
+    history = periods(args.months)
+
+    manifest = {'seed': args.seed, 'password': args.password, 'admin': ADMIN_ID,
+                'volumes': {'agents': args.agents, 'prepaid': args.prepaid, 'postpaid': args.postpaid,
+                            'months': args.months},
+                'regions': {}}
+    totals = {}
+    for company_id, location in COMPANIES.items():
+        app.company_coll().replace_one(
+            {'id': company_id},
+            {'id': company_id, 'user_type': 'company', 'location': location, 'password': pwhash}, upsert=True)
+        app.sync_identity('company', company_id, pwhash, location)
+        ids, counts = seed_region(rng, location, pwhash, args, history)
+        manifest['regions'][app.region_prefix(location)] = {
+            'company': company_id, 'location': location,
+            **{role: [r[0], r[-1]] if r else [] for role, r in ids.items()},  # first and last id
+        }
+        for col_name, n in counts.items():
+            totals[col_name] = totals.get(col_name, 0) + n
+    for dbn, col_name, err in app.ensure_indexes():
+        print(f"WARNING: could not create indexes on {dbn}.{col_name}:", err)
+    # Account summaries for the postpaid list pages
+    for dbn in app.shard_db_names():
+        app.rebuild_accounts(app.get_collections(client[dbn]))
+
+    os.makedirs(os.path.dirname(args.manifest), exist_ok=True)
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"seeded in {time.perf_counter() - start:.1f}s: "
+          + ", ".join(f"{n} {col_name}" for col_name, n in sorted(totals.items())))
+    print(f"manifest written to {args.manifest}")
+
+
+if __name__ == '__main__':
+    main()
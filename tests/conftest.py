@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ENSURE_INDEXES', '0')
+os.environ.setdefault('DB_METRICS', '0')
+
+mongomock = pytest.importorskip('mongomock')
+import app as edb  # noqa: E402
+
+# pymongo >= 4.11 passes sort= to bulk operations, which mongomock does not take
+for _name in ('add_replace', 'add_update'):
+    _add = getattr(mongomock.collection.BulkOperationBuilder, _name)
+
+    def _without_sort(self, *args, _add=_add, sort=None, **kwargs):
+        return _add(self, *args, **kwargs)
+    setattr(mongomock.collection.BulkOperationBuilder, _name, _without_sort)
+
+
+@pytest.fixture
+def shard():
+    """Collections of one mongomock shard with the shard indexes created."""
+    client = mongomock.MongoClient()
+    edb._mongo.update(pid=os.getpid(), client=client)
+    db = client['Nesco1']
+    for col_name, models in edb.SHARD_INDEXES.items():
+        db[col_name].create_indexes(models)
+    return edb.get_collections(db)
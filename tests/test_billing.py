@@ -0,0 +1,49 @@
+from app import account_bill_op, bill_shard, build_bill, flat_amount, tariff_amounts, write_accounts
+
+
+def form_bill(cols, user_id, amount):
+    """What company_bill_user does: new bill on top of the latest one."""
+    old = cols['Bill'].find_one({'id': user_id}, sort=[('_id', -1)])
+    bill = build_bill(user_id, 'rajshahi', amount, '2026-11-15', old)
+    cols['Bill'].insert_one(bill)
+    write_accounts(cols, [account_bill_op({'id': user_id}, bill)])
+    if bill.get('replaces'):
+        cols['Bill'].update_one({'_id': bill['replaces']}, {'$set': {'status': 'replaced'}})
+    return bill
+
+
+def test_rerun_earlier_period_after_later_bill(shard):
+    shard['Postpaid'].insert_one({'id': 1, 'location': 'rajshahi'})
+    bill_shard(shard, '2026-10', '2026-10-15', flat_amount(100.0))
+    current = form_bill(shard, 1, 30.0)
+
+    report = bill_shard(shard, '2026-10', '2026-10-15', flat_amount(100.0))
+
+    assert report == {'billed': 0, 'skipped': 1}
+    assert shard['Bill'].count_documents({'id': 1}) == 2
+    assert shard['Bill'].find_one({'_id': current['_id']})['status'] == 'unpaid'
+    account = shard['Account'].find_one({'_id': 1})
+    assert account['last_bill']['_id'] == current['_id']
+    assert account['outstanding'] == 130.0
+
+
+def test_rerun_same_period_is_a_no_op(shard):
+    shard['Postpaid'].insert_many([{'id': i, 'location': 'rajshahi'} for i in (1, 2)])
+    assert bill_shard(shard, '2026-10', '2026-10-15', flat_amount(100.0)) == {'billed': 2, 'skipped': 0}
+    assert bill_shard(shard, '2026-10', '2026-10-15', flat_amount(100.0)) == {'billed': 0, 'skipped': 2}
+    assert shard['Bill'].count_documents({'status': 'unpaid'}) == 2
+
+
+def test_tariff_bills_only_units_since_last_bill(shard):
+    shard['Postpaid'].insert_one({'id': 1, 'location': 'rajshahi', 'meter_no': 'RH_000001'})
+    shard['Meter_inf'].insert_one({'meter_no': 'RH_000001', 'unit_usage': 100})
+    tariff = tariff_amounts('postpaid')
+    bill_shard(shard, '2026-09', '2026-09-15', tariff)
+    shard['Meter_inf'].update_one({}, {'$set': {'unit_usage': 150}})
+    bill_shard(shard, '2026-10', '2026-10-15', tariff)
+    bill_shard(shard, '2026-11', '2026-11-15', tariff)
+
+    bills = {b['period']: b for b in shard['Bill'].find()}
+    fixed = bills['2026-11']['base_amount']  # no new units: fixed charge only
+    assert bills['2026-09']['base_amount'] > bills['2026-10']['base_amount'] > fixed
+    assert shard['Postpaid'].find_one({'id': 1})['billed_units'] == 150